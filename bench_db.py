@@ -0,0 +1,195 @@
+"""
+    Benchmark of the db layer.
+
+    Fills users and wallets tables of the given sizes in a scratch directory
+    and measures bulk import, lookups, reads, writes and full scans:
+
+        python bench_db.py --records 10000,100000 --backend pickle,sqlite
+
+    Every benchmark reports throughput, p50/p99 latency of one operation
+    and the size of the table files after the run.
+"""
+import os
+import sys
+import random
+import shutil
+import tempfile
+import argparse
+from timeit import default_timer as timer
+
+import db
+from engine import conf
+
+BACKENDS = {
+    "pickle": conf.DB_BACKEND_PICKLE,
+    "sqlite": conf.DB_BACKEND_SQLITE,
+}
+
+def percentile(latencies, p):
+    ''' latency of the p-th percentile, latencies are sorted '''
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(round(p / 100.0 * (len(latencies) - 1))))]
+
+class Result(object):
+    def __init__(self, name, count, total, latencies):
+        self.name = name
+        ''' records (or operations) done in total seconds '''
+        self.count = count
+        self.total = total
+        self.latencies = sorted(latencies)
+
+    def throughput(self):
+        if self.total <= 0:
+            return 0.0
+        return self.count / self.total
+
+    def row(self):
+        return "%-16s %10d %12.0f %10.3f %10.3f" % (self.name, self.count, self.throughput(),
+                                                     percentile(self.latencies, 50) * 1000,
+                                                     percentile(self.latencies, 99) * 1000)
+
+HEADER = "%-16s %10s %12s %10s %10s" % ("benchmark", "records", "records/s", "p50 ms", "p99 ms")
+
+def measure(name, operations, count=None, finish=None):
+    '''
+        run callables, time each of them; count - records done by all of them
+        (default one per callable), finish runs at the end (buffer flush),
+        its time counts in the throughput only
+    '''
+    latencies = []
+    start = timer()
+    for operation in operations:
+        began = timer()
+        operation()
+        latencies.append(timer() - began)
+    if finish is not None:
+        finish()
+    total = timer() - start
+    if count is None:
+        count = len(latencies)
+    return Result(name, count, total, latencies)
+
+def chunks(records, size):
+    for i in xrange(0, len(records), size):
+        yield records[i:i + size]
+
+def files_size(path):
+    size = 0
+    for name in os.listdir(path):
+        size += os.path.getsize(os.path.join(path, name))
+    return size
+
+def run(backend, records, operations, scans, seed):
+    ''' run all benchmarks on a fresh directory, return (results, files size) '''
+    random.seed(seed)
+    directory = tempfile.mkdtemp(prefix="bench_db_")
+    try:
+        conf.DB_BACKEND = backend
+        db.use_directory(directory)
+        results = []
+
+        users = [db.User(account="player%d" % i) for i in xrange(records)]
+        results.append(measure("bulk users",
+                               [lambda chunk=chunk: db.User.import_stream(chunk)
+                                for chunk in chunks(users, db.DBBase.BULK_CHUNK)],
+                               records))
+        uids = [user.id for user in users]
+        wallets = []
+        for uid in uids:
+            wallet = db.Wallet(uid)
+            wallet.value = db.Wallet.DEFAULT_COINS
+            wallets.append(wallet)
+        results.append(measure("bulk wallets",
+                               [lambda chunk=chunk: db.Wallet.import_stream(chunk)
+                                for chunk in chunks(wallets, db.DBBase.BULK_CHUNK)],
+                               records))
+        del users, wallets
+
+        def get_account():
+            db.User().get_account("player%d" % random.randrange(records))
+        results.append(measure("get_account", [get_account] * operations))
+
+        def wallet_get():
+            db.Wallet(random.choice(uids)).get()
+        results.append(measure("wallet get", [wallet_get] * operations))
+
+        def wallet_save():
+            wallet = db.Wallet(random.choice(uids))
+            wallet.value = random.randrange(1000)
+            wallet.save()
+        results.append(measure("wallet save", [wallet_save] * operations,
+                               finish=db.buffer.flush))
+
+        def wallet_update():
+            ''' read-modify-write like a purchase '''
+            wallet = db.Wallet(random.choice(uids))
+            wallet.get()
+            wallet.add_coins(1)
+            wallet.save()
+        results.append(measure("wallet update", [wallet_update] * operations,
+                               finish=db.buffer.flush))
+
+        def scan():
+            for wallet in db.Wallet.export_stream():
+                pass
+        results.append(measure("wallet scan", [scan] * scans, records * scans))
+
+        def reopen():
+            ''' tables are loaded (journal replay) on first use after close '''
+            db.close()
+            db.User().get_account("player0")
+        results.append(measure("reopen users", [reopen] * scans))
+
+        db.close()
+        return results, files_size(directory)
+    finally:
+        db.use_directory(None)
+        shutil.rmtree(directory, ignore_errors=True)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark of the db layer")
+    parser.add_argument("--records", default="10000",
+                        help="table sizes, comma separated (default: %(default)s)")
+    parser.add_argument("--backend", default="pickle,sqlite",
+                        help="backends, comma separated: %s (default: %%(default)s)" %
+                             ", ".join(sorted(BACKENDS.keys())))
+    parser.add_argument("--operations", type=int, default=1000,
+                        help="lookups/reads/writes per benchmark (default: %(default)s)")
+    parser.add_argument("--scans", type=int, default=3,
+                        help="full scans and reopens per benchmark (default: %(default)s)")
+    parser.add_argument("--shards", type=int, default=conf.DB_SHARDS,
+                        help="shards of wallet and store tables (default: %(default)s)")
+    parser.add_argument("--write-behind", type=int, choices=(0, 1), default=int(conf.DB_WRITE_BEHIND),
+                        help="buffer wallet writes (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    args.records = [int(size) for size in args.records.split(",")]
+    args.backend = args.backend.split(",")
+    for backend in args.backend:
+        if not BACKENDS.has_key(backend):
+            parser.error("unknown backend %s" % backend)
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    conf.DB_SHARDS = args.shards
+    conf.DB_WRITE_BEHIND = bool(args.write_behind)
+    backend_before = conf.DB_BACKEND
+    try:
+        for backend in args.backend:
+            for records in args.records:
+                results, size = run(BACKENDS[backend], records, args.operations, args.scans, args.seed)
+                print "== %s, %d records, shards %d, write-behind %d" % (backend, records,
+                                                                         args.shards, args.write_behind)
+                print HEADER
+                for result in results:
+                    print result.row()
+                print "files %.1f KB" % (size / 1024.0)
+                print
+                sys.stdout.flush()
+    finally:
+        conf.DB_BACKEND = backend_before
+
+if __name__ == '__main__':
+    main()
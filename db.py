@@ -1,28 +1,1818 @@
-import pickle
-import uuid
+import os
+import sys
+import re
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import time
 import random
+import sqlite3
+import threading
+import Queue
+import atexit
+import bisect
+import shutil
+import contextlib
+import traceback
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+from engine import conf
 from engine.Utility import read_directories, get_path
 
-""" 
+"""
     Clase to manipulate local database (conenct to db server in real live)
 """
 
+def _replace_file(src, dst):
+    ''' rename src over dst (windows refuse to rename over an existing file) '''
+    if os.name == "nt" and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def _sync_file(path):
+    ''' flush a file written by any process to disk '''
+    if not os.path.exists(path):
+        return
+    synced = open(path, "ab")
+    try:
+        os.fsync(synced.fileno())
+    finally:
+        synced.close()
+
+
+class ConflictError(Exception):
+    ''' record was changed by somebody else since it was read '''
+    pass
+
+
+class FileLock(object):
+    """
+        Advisory lock of a table file, shared by the processes of one host.
+
+        The lock is taken on a separate <table>.lock file (the table file is
+        replaced by compaction). It is reentrant in a process, so a commit can
+        hold the locks of all its tables while the tables take them again.
+        Threads of the process are kept out by mutex (an RLock).
+    """
+    SUFFIX = ".lock"
+
+    def __init__(self, path, mutex=None):
+        self.path = path + FileLock.SUFFIX
+        self.lock = mutex or threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+
+    def acquire(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            try:
+                self.lock_file = open(self.path, DBBase.DB_APPEND_FLAG)
+                if fcntl is not None:
+                    fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self.lock_file.seek(0)
+                    msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            except:
+                self.lock.release()
+                raise
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.lock_file.seek(0)
+                msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.lock_file.close()
+            self.lock_file = None
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+class LockGroup(object):
+    ''' hold several locks, always taken in the same (path) order '''
+    def __init__(self, locks):
+        self.locks = sorted(set(locks), key=lambda lock: lock.path)
+
+    def __enter__(self):
+        taken = []
+        try:
+            for lock in self.locks:
+                lock.acquire()
+                taken.append(lock)
+        except:
+            for lock in reversed(taken):
+                lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for lock in reversed(self.locks):
+            lock.release()
+        return False
+
+
+class HandlePool(object):
+    """
+        Resolved table paths, open append handles and sqlite connections.
+
+        Table paths are looked up once, files written by the journal stores
+        stay open for appending and one sqlite connection is kept per
+        database and thread. close() releases everything; it runs at exit too.
+    """
+    STATEMENT_CACHE = 64
+
+    def __init__(self):
+        self.paths = {}
+        self.files = {}
+        self.connections = {}
+        ''' tables are kept here instead of the data directories (see use_directory) '''
+        self.directory = None
+
+    def resolve(self, name):
+        ''' return path of db file, resolve directories only once per name '''
+        path = self.paths.get(name)
+        if path is None and self.directory is not None:
+            path = os.path.join(self.directory, name)
+            self.paths[name] = path
+        if path is None:
+            dirs = read_directories(DBBase.DB_DIR)
+            path = get_path(name, dirs)
+            if path is None:
+                ''' table not created yet - create it in the db directory '''
+                db_dirs = [d for d in dirs if os.path.basename(d) == DBBase.DB_DIR]
+                if db_dirs:
+                    path = os.path.join(db_dirs[0], name)
+                else:
+                    path = os.path.join(dirs[0], name)
+            self.paths[name] = path
+        return path
+
+    def append_file(self, path):
+        ''' return file opened for appending, open it on first use '''
+        db_file = self.files.get(path)
+        if db_file is None:
+            db_file = open(path, DBBase.DB_APPEND_FLAG)
+            self.files[path] = db_file
+        return db_file
+
+    def release(self, path):
+        ''' close append handle (file is going to be replaced or truncated) '''
+        db_file = self.files.pop(path, None)
+        if db_file is not None:
+            db_file.close()
+
+    def connection(self, path):
+        ''' return sqlite connection of the current thread, open it on first use '''
+        key = (path, threading.current_thread().ident)
+        conn = self.connections.get(key)
+        if conn is None:
+            ''' used by one thread only, closed by close() from any thread '''
+            conn = sqlite3.connect(path, cached_statements=HandlePool.STATEMENT_CACHE,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.connections[key] = conn
+        return conn
+
+    def close(self):
+        for path in self.files.keys():
+            self.release(path)
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+handles = HandlePool()
+atexit.register(handles.close)
+
+
+class IdGenerator(object):
+    """
+        Time ordered 64 bit ids, no hashing.
+
+        An id is milliseconds since EPOCH (41 bits), a node number of the
+        process (10 bits) and a per-process sequence (12 bits). Ids of one
+        process always grow; when more than 4096 ids are needed in one
+        millisecond the next millisecond is borrowed.
+
+        The node is taken on the first id: the first of the ids.<node>.lock
+        files in the db directory which no other process has locked, it stays
+        locked until the process exits. Games sharing the data directory get
+        different nodes, so their ids never collide.
+    """
+    EPOCH = 1388534400000L
+    NODE_BITS = 10
+    NODE_MASK = (1 << NODE_BITS) - 1
+    SEQUENCE_BITS = 12
+    SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+    NODE_FILE = "ids.%d" + FileLock.SUFFIX
+
+    def __init__(self, node=None):
+        self.fixed = node is not None
+        self.node = node & IdGenerator.NODE_MASK if self.fixed else None
+        ''' process the node was taken by - a forked child takes its own '''
+        self.pid = None
+        self.node_file = None
+        self.last_time = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def take_node(self):
+        ''' lock the first free node file, return its node '''
+        if self.node_file is not None:
+            ''' inherited from the parent process, it keeps the lock '''
+            self.node_file.close()
+            self.node_file = None
+        for node in range(IdGenerator.NODE_MASK + 1):
+            try:
+                node_file = open(handles.resolve(IdGenerator.NODE_FILE % node), DBBase.DB_APPEND_FLAG)
+            except IOError:
+                break
+            try:
+                if fcntl is not None:
+                    fcntl.flock(node_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    node_file.seek(0)
+                    msvcrt.locking(node_file.fileno(), msvcrt.LK_NBLCK, 1)
+            except IOError:
+                node_file.close()
+                continue
+            self.node_file = node_file
+            return node
+        ''' no db directory (or all nodes taken) - pid is the best guess '''
+        return os.getpid() & IdGenerator.NODE_MASK
+
+    def next_id(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                if not self.fixed:
+                    self.node = self.take_node()
+            now = long(time.time() * 1000) - IdGenerator.EPOCH
+            if now <= self.last_time:
+                ''' same millisecond (or clock went back) - next sequence '''
+                self.sequence = (self.sequence + 1) & IdGenerator.SEQUENCE_MASK
+                if self.sequence == 0:
+                    self.last_time += 1
+            else:
+                self.sequence = 0
+                self.last_time = now
+            return ((self.last_time << (IdGenerator.NODE_BITS + IdGenerator.SEQUENCE_BITS)) |
+                    (self.node << IdGenerator.SEQUENCE_BITS) | self.sequence)
+
+ids = IdGenerator()
+
+
+class TableStore(object):
+    """
+        Base class for table storage backends.
+
+        Writes are (op, key, value) entries; a set written by the
+        write-behind buffer carries the version to write as 4th item. Inside
+        a transaction entries are staged in the transaction and written by
+        its commit.
+
+        Every record has a version, incremented by each write (0 - record
+        does not exist). A write can pass the versions of the records when
+        they were read; it fails with ConflictError if somebody else wrote
+        them in the meantime.
+
+        put() of a buffered store (see DBBase.WRITE_BEHIND) outside of a
+        transaction goes to the write-behind buffer; reads see the buffered
+        values, other writes of a buffered key flush it first.
+    """
+    OP_SET = "S"
+    OP_DELETE = "D"
+
+    def __init__(self, name):
+        self.name = name
+        self.buffered = False
+
+    def get(self, key, default=None):
+        tx = Transaction.current()
+        if tx is not None and tx.is_staged(self, key):
+            return tx.get_staged(self, key, default)
+        if self.buffered and buffer.is_pending(self, key):
+            try:
+                return buffer.get(self, key)
+            except KeyError:
+                ''' flushed meanwhile '''
+                pass
+        return self._get(key, default)
+
+    def get_all(self):
+        buffer.flush_store(self)
+        return self._get_all()
+
+    def has_key(self, key):
+        if self.buffered and buffer.is_pending(self, key):
+            return True
+        return self._has_key(key)
+
+    def keys(self):
+        buffer.flush_store(self)
+        return self._keys()
+
+    def iter_items(self):
+        buffer.flush_store(self)
+        return self._iter_items()
+
+    def find(self, field, value):
+        ''' (key, record) items of the records whose field is value '''
+        buffer.flush_store(self)
+        return self._find(field, value)
+
+    def version(self, key):
+        if self.buffered and buffer.is_pending(self, key):
+            try:
+                return buffer.version(self, key)
+            except KeyError:
+                pass
+        return self._version(key)
+
+    def put(self, key, value, version=None):
+        if self.buffered and Transaction.current() is None:
+            buffer.put(self, key, value, version)
+        else:
+            self.write([(TableStore.OP_SET, key, value)], self._expected(key, version))
+
+    def put_many(self, items):
+        self.write([(TableStore.OP_SET, key, value) for key, value in items])
+
+    def delete(self, key, version=None):
+        self.write([(TableStore.OP_DELETE, key, None)], self._expected(key, version))
+
+    def _expected(self, key, version):
+        if version is None:
+            return None
+        return {key: version}
+
+    def write(self, entries, expected=None):
+        if self.buffered:
+            ''' buffered values of the keys are older - write them first '''
+            buffer.flush_keys(self, [entry[1] for entry in entries])
+        tx = Transaction.current()
+        if tx is not None:
+            tx.stage(self, entries, expected)
+        else:
+            self._write(entries, expected=expected)
+
+    def check(self, expected):
+        ''' raise ConflictError if a record was written since it was read '''
+        if not expected:
+            return
+        for key, version in expected.items():
+            if self._version(key) != version:
+                raise ConflictError, "%s: record %s was changed" % (self.name, key)
+
+    def locks(self, keys=None):
+        ''' file locks to hold while the keys (None - any key) are written '''
+        return []
+
+    def refresh(self):
+        pass
+
+    def is_damaged(self, key=None):
+        ''' True if the file of the key (None - any file) was unreadable and set aside '''
+        return False
+
+    def repaired(self):
+        pass
+
+    def _get(self, key, default=None):
+        raise NotImplementedError
+
+    def _get_all(self):
+        raise NotImplementedError
+
+    def _has_key(self, key):
+        raise NotImplementedError
+
+    def _keys(self):
+        raise NotImplementedError
+
+    def _iter_items(self):
+        raise NotImplementedError
+
+    def _find(self, field, value):
+        ''' no index - scan the table '''
+        return [(key, record) for key, record in self._iter_items()
+                if record_field(self.name, record, field) == value]
+
+    def _version(self, key):
+        raise NotImplementedError
+
+    def _write(self, entries, txid=None, expected=None):
+        raise NotImplementedError
+
+
+class WriteBuffer(object):
+    """
+        Write-behind buffer of per player tables (wallet, store).
+
+        put() keeps only the last value of a key, so a session saving the
+        wallet many times costs one record per flush. Pending records are
+        written together by flush(): FLUSH_SECONDS after the first pending
+        write (by the flusher thread), when FLUSH_RECORDS keys are pending, before any other write of
+        a pending key (transactions are not buffered) and at exit.
+
+        Every put() of a buffered record gets the next version, as if it was
+        written; the flush writes the last one, if the record still has the
+        version it had when it was buffered. A ConflictError found by a
+        background flush (another process wrote the record meanwhile) can
+        not be returned to the put() any more - it is kept with the key and
+        raised by the next write of the same key; errors nobody asked for
+        are printed at exit. The lost write is reported, not retried, so
+        the buffer is off (see conf.DB_WRITE_BEHIND) when several game
+        processes share the tables.
+    """
+    FLUSH_SECONDS = 2.0
+    FLUSH_RECORDS = 256
+
+    def __init__(self):
+        ''' store -> {key: (value, version when buffered, checked, version to write)} '''
+        self.pending = {}
+        self.count = 0
+        ''' store name -> {key: ConflictError of its last buffered write} '''
+        self.errors = {}
+        self.lock = threading.RLock()
+        ''' flusher thread waits on it until the first pending record is due '''
+        self.wakeup = threading.Condition(self.lock)
+        self.due = None
+        self.thread = None
+        self.closed = False
+
+    def is_pending(self, store, key):
+        records = self.pending.get(store)
+        return records is not None and key in records
+
+    def get(self, store, key):
+        ''' buffered value, KeyError if the key was flushed since is_pending() '''
+        with self.lock:
+            return self.pending[store][key][0]
+
+    def version(self, store, key):
+        ''' version the buffered record gets when it is written '''
+        with self.lock:
+            return self.pending[store][key][3]
+
+    def put(self, store, key, value, version=None):
+        with self.lock:
+            self.raise_error(store, key)
+            records = self.pending.setdefault(store, {})
+            if key in records:
+                old_value, base, checked, current = records[key]
+            else:
+                base = current = store._version(key)
+                checked = version is not None
+                self.count += 1
+            if version is not None and version != current:
+                raise ConflictError, "%s: record %s was changed" % (store.name, key)
+            records[key] = (value, base, checked, current + 1)
+            if self.count >= WriteBuffer.FLUSH_RECORDS or self.closed:
+                self.flush()
+            elif self.due is None:
+                self.due = time.time() + WriteBuffer.FLUSH_SECONDS
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="db-write-behind")
+                    self.thread.daemon = True
+                    self.thread.start()
+                self.wakeup.notify()
+
+    def flush_keys(self, store, keys):
+        ''' flush store if some of the keys are pending, raise a lost write of the keys '''
+        if self.pending.get(store):
+            for key in keys:
+                if self.is_pending(store, key):
+                    self.flush_store(store)
+                    break
+        if self.errors.get(store.name):
+            with self.lock:
+                for key in keys:
+                    self.raise_error(store, key)
+
+    def flush_store(self, store):
+        if self.pending.get(store):
+            with self.lock:
+                records = self.pending.pop(store, {})
+                self.count -= len(records)
+                self._write(store, records)
+
+    def flush(self):
+        ''' write all pending records, a failed one is raised by the next write of its key '''
+        with self.lock:
+            self.due = None
+            pending, self.pending, self.count = self.pending, {}, 0
+            for store, records in pending.items():
+                self._write(store, records)
+
+    def run(self):
+        ''' flusher thread '''
+        with self.lock:
+            while not self.closed:
+                if self.due is None:
+                    self.wakeup.wait()
+                elif self.due > time.time():
+                    self.wakeup.wait(self.due - time.time())
+                else:
+                    self.flush()
+
+    def close(self):
+        ''' stop the flusher thread and flush (at exit), print lost writes nobody was told about '''
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+        with self.lock:
+            errors, self.errors = self.errors, {}
+        for name, keys in sorted(errors.items()):
+            for key, error in sorted(keys.items()):
+                print >> sys.stderr, "db: write of %s was lost: %s" % (name, error)
+
+    def raise_error(self, store, key):
+        ''' raise (once) the conflict of the last flushed write of the key '''
+        errors = self.errors.get(store.name)
+        if errors and key in errors:
+            error = errors.pop(key)
+            raise error
+
+    def _write(self, store, records):
+        if not records:
+            return
+        entries = [(TableStore.OP_SET, key, value, version)
+                   for key, (value, base, checked, version) in records.items()]
+        expected = dict([(key, base) for key, (value, base, checked, version) in records.items()
+                         if checked])
+        try:
+            store._write(entries, expected=expected)
+        except ConflictError:
+            ''' write what can be written, keep the rest for the owners of the keys '''
+            for key, (value, base, checked, version) in records.items():
+                try:
+                    store._write([(TableStore.OP_SET, key, value, version)],
+                                 expected=store._expected(key, base if checked else None))
+                except ConflictError, error:
+                    self.errors.setdefault(store.name, {})[key] = error
+
+buffer = WriteBuffer()
+atexit.register(buffer.close)
+
+
+class JournalStore(TableStore):
+    """
+        Append-only table file.
+
+        The file is a stream of pickles: an optional snapshot (the whole table
+        as a dict) followed by mutation records (op, key, value, version).
+        Opening the store replays the stream into an in-memory index, so a
+        write appends one record to the end of file instead of rewriting the
+        whole table. When the log gets bigger than the table it is compacted
+        into a new snapshot, written to a temporary file and renamed over the
+        table.
+
+        The index is kept between calls (see DBBase._get_store); refresh()
+        replays only the records appended since the last read, and reloads
+        the whole file when it was compacted by another process. Writes and
+        compaction hold the table FileLock, readers do not need it; threads
+        of the process share the index under mutex.
+    """
+    ''' marks the last transaction written to the file (see CommitLog) '''
+    OP_TX = "T"
+    ''' first record of a compacted file - changes with every compaction '''
+    OP_HEADER = "H"
+    ''' record versions of the snapshot '''
+    OP_VERSIONS = "V"
+    ''' compact when log has more than COMPACT_RATIO * live records '''
+    COMPACT_RATIO = 2
+    COMPACT_MIN_RECORDS = 64
+    ''' unreadable table file is renamed to <table>.damaged '''
+    DAMAGED_SUFFIX = ".damaged"
+
+    def __init__(self, path, name=None):
+        TableStore.__init__(self, name)
+        self.path = path
+        self.mutex = threading.RLock()
+        self.lock = FileLock(path, self.mutex)
+        self.records = {}
+        self.versions = {}
+        self.log_records = 0
+        self.last_txid = 0
+        self.token = None
+        self.offset = 0
+        self.signature = None
+        self.damaged = False
+        self.load()
+
+    def _stat(self):
+        ''' file signature used to detect changes made outside this store '''
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _read_token(self):
+        ''' header token of the file (None - file was never compacted) '''
+        try:
+            db_file = open(self.path, DBBase.DB_READ_FLAG)
+        except IOError:
+            return None
+        try:
+            try:
+                entry = pickle.load(db_file)
+            except Exception:
+                return None
+        finally:
+            db_file.close()
+        if isinstance(entry, tuple) and entry[0] == JournalStore.OP_HEADER:
+            return entry[2]
+        return None
+
+    def refresh(self):
+        ''' read the records written by others since last load/write '''
+        with self.mutex:
+            signature = self._stat()
+            if signature == self.signature:
+                return
+            if (signature is None or self.signature is None or signature[0] != self.signature[0]
+                    or signature[1] < self.offset or self._read_token() != self.token):
+                ''' file was replaced (compacted) - read it again '''
+                self.load()
+            else:
+                self._replay(signature)
+
+    def load(self):
+        ''' rebuild in-memory index from snapshot and log records '''
+        with self.mutex:
+            self.records = {}
+            self.versions = {}
+            self.log_records = 0
+            self.last_txid = 0
+            self.token = None
+            self.offset = 0
+            ''' append handle may point to a file replaced by another process '''
+            handles.release(self.path)
+            signature = self._stat()
+            if signature is None:
+                self.signature = None
+                return
+            self._replay(signature)
+            if self.offset == 0 and signature[1] > 0:
+                self._set_aside()
+
+    def _set_aside(self):
+        '''
+            not even the first record of the file can be read (table written
+            in place by an old version and broken by a crash) - rename the
+            file and start empty, DBBase writes its records back from the
+            last snapshot (see Snapshots.repair)
+        '''
+        with self.lock:
+            signature = self._stat()
+            if signature is not None:
+                ''' the file may have been just created by another process '''
+                self._replay(signature)
+            if signature is None or self.offset > 0 or signature[1] == 0:
+                return
+            handles.release(self.path)
+            _replace_file(self.path, self.path + JournalStore.DAMAGED_SUFFIX)
+            print >> sys.stderr, "db: %s can not be read, moved to %s%s" % (
+                self.path, self.path, JournalStore.DAMAGED_SUFFIX)
+            self.records = {}
+            self.versions = {}
+            self.signature = None
+            self.damaged = True
+
+    def is_damaged(self, key=None):
+        return self.damaged
+
+    def repaired(self):
+        self.damaged = False
+
+    def _truncate_torn(self):
+        '''
+            cut off a record half written by a crashed process, appends would
+            follow it and could not be read any more (the table lock is held)
+        '''
+        if self.signature is None or self.signature[1] <= self.offset:
+            return
+        if self.offset == 0:
+            self._set_aside()
+            return
+        handles.release(self.path)
+        db_file = open(self.path, "r+b")
+        try:
+            db_file.truncate(self.offset)
+            db_file.flush()
+            os.fsync(db_file.fileno())
+        finally:
+            db_file.close()
+        self.signature = self._stat()
+
+    def _replay(self, signature):
+        ''' apply records from self.offset to the end of file '''
+        self.signature = signature
+        db_file = open(self.path, DBBase.DB_READ_FLAG)
+        try:
+            db_file.seek(self.offset)
+            while True:
+                try:
+                    entry = pickle.load(db_file)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, IndexError, KeyError):
+                    ''' record is being written by another process '''
+                    break
+                if isinstance(entry, dict):
+                    ''' snapshot (legacy files contain only this) '''
+                    self.records = entry
+                    self.versions = {}
+                    self.log_records = 0
+                else:
+                    self._apply(entry)
+                    self.log_records += 1
+                self.offset = db_file.tell()
+        finally:
+            db_file.close()
+
+    def _apply(self, entry):
+        op, key, value = entry[:3]
+        if op == TableStore.OP_SET:
+            self.records[key] = value
+            if len(entry) > 3:
+                self.versions[key] = entry[3]
+            else:
+                self.versions[key] = self.versions.get(key, 0) + 1
+        elif op == TableStore.OP_DELETE:
+            self.records.pop(key, None)
+            self.versions.pop(key, None)
+        elif op == JournalStore.OP_TX:
+            self.last_txid = value
+        elif op == JournalStore.OP_HEADER:
+            self.token = value
+        elif op == JournalStore.OP_VERSIONS:
+            self.versions = value
+
+    def _get_all(self):
+        with self.mutex:
+            return dict(self.records)
+
+    def _get(self, key, default=None):
+        with self.mutex:
+            return self.records.get(key, default)
+
+    def _has_key(self, key):
+        with self.mutex:
+            return key in self.records
+
+    def _keys(self):
+        with self.mutex:
+            return self.records.keys()
+
+    def _iter_items(self):
+        with self.mutex:
+            items = self.records.items()
+        for item in items:
+            yield item
+
+    def _version(self, key):
+        with self.mutex:
+            return self.versions.get(key, 0)
+
+    @property
+    def newest_txid(self):
+        return self.last_txid
+
+    def locks(self, keys=None):
+        return [self.lock]
+
+    def _write(self, entries, txid=None, expected=None):
+        with self.lock:
+            self.refresh()
+            self.check(expected)
+            self._truncate_torn()
+            self._append(entries, txid)
+
+    def _append(self, entries, txid=None):
+        ''' write entries at the end of file, the table lock is held '''
+        versions = {}
+        records = []
+        for entry in entries:
+            op, key, value = entry[:3]
+            if op == TableStore.OP_SET:
+                if len(entry) > 3:
+                    versions[key] = entry[3]
+                else:
+                    versions[key] = versions.get(key, self._version(key)) + 1
+                records.append((op, key, value, versions[key]))
+            else:
+                versions[key] = 0
+                records.append((op, key, value))
+        if txid is not None:
+            records.append((JournalStore.OP_TX, None, txid))
+        db_file = handles.append_file(self.path)
+        for record in records:
+            pickle.dump(record, db_file, pickle.HIGHEST_PROTOCOL)
+        db_file.flush()
+        for record in records:
+            self._apply(record)
+        self.log_records += len(records)
+        self.offset = db_file.tell()
+        self.signature = self._stat()
+        if self.need_compact():
+            self.compact()
+
+    def need_compact(self):
+        limit = max(JournalStore.COMPACT_MIN_RECORDS,
+                    JournalStore.COMPACT_RATIO * len(self.records))
+        return self.log_records > limit
+
+    def compact(self):
+        ''' write live records as a new snapshot and drop the log '''
+        with self.lock:
+            self.refresh()
+            token = random.getrandbits(64)
+            tmp_path = self.path + ".tmp"
+            db_file = open(tmp_path, DBBase.DB_WRITE_FLAG)
+            try:
+                pickle.dump((JournalStore.OP_HEADER, None, token), db_file, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self.records, db_file, pickle.HIGHEST_PROTOCOL)
+                pickle.dump((JournalStore.OP_VERSIONS, None, self.versions), db_file,
+                            pickle.HIGHEST_PROTOCOL)
+                if self.last_txid:
+                    pickle.dump((JournalStore.OP_TX, None, self.last_txid), db_file,
+                                pickle.HIGHEST_PROTOCOL)
+                db_file.flush()
+                os.fsync(db_file.fileno())
+                offset = db_file.tell()
+            finally:
+                db_file.close()
+            handles.release(self.path)
+            _replace_file(tmp_path, self.path)
+            self.token = token
+            self.offset = offset
+            self.log_records = 0
+            self.signature = self._stat()
+
+    def sync(self):
+        ''' flush table file to disk '''
+        if os.path.exists(self.path):
+            os.fsync(handles.append_file(self.path).fileno())
+
+
+class ShardedStore(TableStore):
+    """
+        Table split into shards by crc32 of the key, one JournalStore per shard.
+
+        A write touches only the shard file of its key, so saving one wallet
+        does not append to (or compact) the file of all the others. Shard
+        files are named <table>.<index>-<shards>.db; when the files for the
+        configured number of shards do not exist yet, the old single file
+        and shards of another count are copied into the new ones. Then the
+        shards of another count are removed and the single file is renamed
+        to <table>.migrated, so a later migration does not read it again.
+    """
+    SHARD_NAME = "%s.%d-%d%s"
+    MIGRATED_SUFFIX = ".migrated"
+
+    def __init__(self, path, name, count):
+        TableStore.__init__(self, name)
+        self.path = path
+        self.count = max(1, count)
+        self.shards = [JournalStore(self.shard_path(index, self.count), name)
+                       for index in range(self.count)]
+
+    def shard_path(self, index, count):
+        base, ext = os.path.splitext(self.path)
+        return ShardedStore.SHARD_NAME % (base, index, count, ext)
+
+    def old_shard_paths(self):
+        ''' shard files of other shard counts '''
+        directory = os.path.dirname(self.path) or "."
+        base, ext = os.path.splitext(os.path.basename(self.path))
+        pattern = re.compile(r"^%s\.(\d+)-(\d+)%s$" % (re.escape(base), re.escape(ext)))
+        paths = []
+        for filename in os.listdir(directory):
+            found = pattern.match(filename)
+            if found and int(found.group(2)) != self.count:
+                paths.append(os.path.join(directory, filename))
+        return sorted(paths)
+
+    def migrate(self):
+        ''' copy old table files into the shards, return number of records '''
+        with self.shards[0].lock:
+            self.refresh()
+            for shard in self.shards:
+                if shard.signature is not None:
+                    return 0
+            return self._migrate()
+
+    def _migrate(self):
+        old_paths = self.old_shard_paths()
+        records = {}
+        for path in [self.path] + old_paths:
+            if os.path.exists(path):
+                records.update(JournalStore(path).get_all())
+        for shard in self.shards:
+            ''' empty shard files mark the table as migrated '''
+            open(shard.path, DBBase.DB_APPEND_FLAG).close()
+        self._write([(TableStore.OP_SET, key, value) for key, value in records.items()])
+        for path in old_paths:
+            handles.release(path)
+            os.remove(path)
+        if os.path.exists(self.path):
+            handles.release(self.path)
+            _replace_file(self.path, self.path + ShardedStore.MIGRATED_SUFFIX)
+        return len(records)
+
+    def shard(self, key):
+        return self.shards[(zlib.crc32(str(key)) & 0xffffffff) % self.count]
+
+    @property
+    def last_txid(self):
+        ''' oldest transaction written to all shards (see CommitLog.recover) '''
+        return min([shard.last_txid for shard in self.shards])
+
+    @property
+    def newest_txid(self):
+        return max([shard.last_txid for shard in self.shards])
+
+    def refresh(self):
+        for shard in self.shards:
+            shard.refresh()
+
+    def _get_all(self):
+        records = {}
+        for shard in self.shards:
+            records.update(shard.get_all())
+        return records
+
+    def _get(self, key, default=None):
+        return self.shard(key)._get(key, default)
+
+    def _has_key(self, key):
+        return self.shard(key).has_key(key)
+
+    def _keys(self):
+        keys = []
+        for shard in self.shards:
+            keys.extend(shard.keys())
+        return keys
+
+    def _iter_items(self):
+        for shard in self.shards:
+            for item in shard._iter_items():
+                yield item
+
+    def _version(self, key):
+        return self.shard(key).version(key)
+
+    def locks(self, keys=None):
+        if keys is None:
+            return [shard.lock for shard in self.shards]
+        return [self.shard(key).lock for key in keys]
+
+    def is_damaged(self, key=None):
+        if key is None:
+            return True in [shard.is_damaged() for shard in self.shards]
+        return self.shard(key).is_damaged()
+
+    def repaired(self):
+        for shard in self.shards:
+            shard.repaired()
+
+    def _write(self, entries, txid=None, expected=None):
+        by_shard = {}
+        for entry in entries:
+            by_shard.setdefault(self.shard(entry[1]), []).append(entry)
+        with LockGroup(self.locks([entry[1] for entry in entries] + (expected or {}).keys())):
+            for shard in by_shard:
+                shard.refresh()
+            self.check(expected)
+            for shard, shard_entries in by_shard.items():
+                if txid is not None and shard.last_txid >= txid:
+                    ''' recovered transaction already in this shard '''
+                    continue
+                shard._write(shard_entries, txid)
+
+    def compact(self):
+        for shard in self.shards:
+            shard.compact()
+
+    def sync(self):
+        for shard in self.shards:
+            shard.sync()
+
+
+class SqliteStore(TableStore):
+    """
+        Table kept in a SQLite database (enabled with BACKEND = sqlite in config).
+
+        Records are pickled in the 'data' column. The record key and a few
+        record fields get their own indexed columns, so lookups by
+        account, uid or product name are index searches. SQL statements are
+        built once per table, so the connection statement cache reuses the
+        prepared statements. Writes with expected versions are conditional
+        updates (... WHERE version = ?), sqlite does the locking.
+    """
+    ''' table file -> (sql table, key column, {indexed column: record field}) '''
+    SCHEMA = {
+        "users.db": ("users", "account", {"uid": "id"}),
+        "products.db": ("products", "name", {"uid": "id"}),
+        "wallet.db": ("wallet", "uid", {}),
+        "store.db": ("store", "uid", {}),
+        "landings.db": ("landings", "id", {"uid": "uid", "session": "session"}),
+        "leaderboard.db": ("leaderboard", "name", {}),
+    }
+
+    def __init__(self, path, name, legacy=None):
+        TableStore.__init__(self, name)
+        self.path = path
+        if SqliteStore.SCHEMA.has_key(name):
+            self.table, self.key_column, self.columns = SqliteStore.SCHEMA[name]
+        else:
+            self.table, self.key_column, self.columns = os.path.splitext(name)[0], "key", {}
+        self.column_names = sorted(self.columns.keys())
+
+        table, key = self.table, self.key_column
+        columns = ", ".join([key] + self.column_names + ["data", "version"])
+        values = ", ".join(["?"] * (len(self.column_names) + 2))
+        updates = ", ".join(["%s = ?" % column for column in self.column_names + ["data"]])
+        self.sql_get = "SELECT data FROM %s WHERE %s = ?" % (table, key)
+        self.sql_has = "SELECT 1 FROM %s WHERE %s = ?" % (table, key)
+        self.sql_all = "SELECT data FROM %s" % table
+        ''' record field -> query by its indexed column '''
+        self.sql_find = dict([(field, "SELECT data FROM %s WHERE %s = ?" % (table, column))
+                              for column, field in self.columns.items()])
+        self.sql_version = "SELECT version FROM %s WHERE %s = ?" % (table, key)
+        self.sql_put = ("INSERT OR REPLACE INTO %s (%s) VALUES (%s, COALESCE((SELECT version FROM %s WHERE %s = ?), 0) + 1)" %
+                        (table, columns, values, table, key))
+        self.sql_put_version = "INSERT OR REPLACE INTO %s (%s) VALUES (%s, ?)" % (table, columns, values)
+        self.sql_insert = "INSERT INTO %s (%s) VALUES (%s, ?)" % (table, columns, values)
+        self.sql_update = ("UPDATE %s SET %s, version = ? WHERE %s = ? AND version = ?" %
+                           (table, updates, key))
+        self.sql_delete = "DELETE FROM %s WHERE %s = ?" % (table, key)
+        self.sql_delete_version = "DELETE FROM %s WHERE %s = ? AND version = ?" % (table, key)
+
+        with FileLock(self.path):
+            ''' other processes wait until the table is created and imported '''
+            if self._create_table() and legacy is not None:
+                ''' first run with sqlite backend - import table of the pickle backend
+                    (written at once, even when the table is opened in a transaction) '''
+                self._write([(TableStore.OP_SET, key, value)
+                             for key, value in legacy().get_all().items()])
+
+    @property
+    def conn(self):
+        ''' connection of the current thread '''
+        return handles.connection(self.path)
+
+    def _create_table(self):
+        ''' create table and indexes, return True if the table is new '''
+        found = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                  (self.table,)).fetchone()
+        if found:
+            table_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(%s)" % self.table)]
+            if "version" not in table_columns:
+                ''' table created by an older version '''
+                with self.conn:
+                    self.conn.execute("ALTER TABLE %s ADD COLUMN version INTEGER NOT NULL DEFAULT 0" %
+                                      self.table)
+            return False
+        columns = ["%s TEXT PRIMARY KEY" % self.key_column]
+        columns += ["%s TEXT" % column for column in self.column_names]
+        columns.append("data BLOB NOT NULL")
+        columns.append("version INTEGER NOT NULL DEFAULT 0")
+        with self.conn:
+            self.conn.execute("CREATE TABLE %s (%s)" % (self.table, ", ".join(columns)))
+            for column in self.column_names:
+                self.conn.execute("CREATE INDEX %s_%s ON %s (%s)" % (self.table, column, self.table, column))
+        return True
+
+    def _key(self, key):
+        return str(key)
+
+    def _row(self, key, value):
+        row = [self._key(key)]
+        for column in self.column_names:
+            attr = record_field(self.name, value, self.columns[column])
+            if attr is not None:
+                attr = str(attr)
+            row.append(attr)
+        ''' keep the original key (uid is an UUID, not str) next to the record '''
+        row.append(sqlite3.Binary(pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)))
+        return row
+
+    def _load(self, data):
+        return pickle.loads(str(data))
+
+    def _get_all(self):
+        return dict([self._load(row[0]) for row in self.conn.execute(self.sql_all)])
+
+    def _get(self, key, default=None):
+        row = self.conn.execute(self.sql_get, (self._key(key),)).fetchone()
+        if row is None:
+            return default
+        return self._load(row[0])[1]
+
+    def _has_key(self, key):
+        return self.conn.execute(self.sql_has, (self._key(key),)).fetchone() is not None
+
+    def _keys(self):
+        return self.get_all().keys()
+
+    def _iter_items(self):
+        ''' stream records from a cursor, the table is not loaded at once '''
+        for row in self.conn.cursor().execute(self.sql_all):
+            yield self._load(row[0])
+
+    def _find(self, field, value):
+        sql = self.sql_find.get(field)
+        if sql is None or value is None:
+            return TableStore._find(self, field, value)
+        return [self._load(row[0]) for row in self.conn.execute(sql, (str(value),))]
+
+    def _version(self, key):
+        row = self.conn.execute(self.sql_version, (self._key(key),)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def _write(self, entries, txid=None, expected=None):
+        with self.conn:
+            self._execute(entries, expected)
+
+    def _execute(self, entries, expected=None):
+        ''' run entries in the current sqlite transaction '''
+        expected = dict(expected or {})
+        run_op, run = None, []
+        for entry in entries:
+            op, key, value = entry[:3]
+            if expected.has_key(key) or len(entry) > 3:
+                self._execute_many(run_op, run)
+                run_op, run = None, []
+                self._execute_checked(op, key, value, expected.pop(key, None), *entry[3:])
+                continue
+            if op != run_op:
+                self._execute_many(run_op, run)
+                run_op, run = op, []
+            if op == TableStore.OP_SET:
+                run.append(self._row(key, value))
+            else:
+                run.append((self._key(key),))
+        self._execute_many(run_op, run)
+
+    def _execute_many(self, op, rows):
+        if not rows:
+            return
+        if op == TableStore.OP_SET:
+            self.conn.executemany(self.sql_put, [row + [row[0]] for row in rows])
+        else:
+            self.conn.executemany(self.sql_delete, rows)
+
+    def _execute_checked(self, op, key, value, version, new_version=None):
+        '''
+            write one record if its version is still the expected one
+            (version None - not checked, new_version given by the write-behind buffer)
+        '''
+        if op == TableStore.OP_SET:
+            row = self._row(key, value)
+            if version is None:
+                self.conn.execute(self.sql_put_version, row + [new_version])
+                return
+            if new_version is None:
+                new_version = version + 1
+            done = self.conn.execute(self.sql_update, row[1:] + [new_version, row[0], version]).rowcount
+            if not done and version == 0:
+                try:
+                    done = self.conn.execute(self.sql_insert, row + [new_version]).rowcount
+                except sqlite3.IntegrityError:
+                    done = 0
+        else:
+            done = self.conn.execute(self.sql_delete_version, (self._key(key), version)).rowcount
+            if not done and version == 0:
+                done = not self.has_key(key)
+        if not done:
+            raise ConflictError, "%s: record %s was changed" % (self.name, key)
+
+
+class CommitLog(object):
+    """
+        Redo log for transactions of the pickle backend.
+
+        A commit appends all entries of the transaction as one record and
+        fsyncs the log once; the tables are then appended without syncing.
+        Every table file remembers the last transaction it got (OP_TX record),
+        so when a table is opened the transactions it missed (crash in the
+        middle of a commit) are applied again from the log. The log is
+        truncated at checkpoint, after the table files were synced.
+
+        The log lock is held from the log append until the tables are
+        written, so other processes do not recover a commit in progress.
+        A record half written by a crashed commit is cut off before the next
+        append; the log is read from where this process saw its end, unless
+        another process did a checkpoint (new header token) meanwhile.
+    """
+    NAME = "commit.journal"
+    CHECKPOINT_RECORDS = 128
+    ''' first record of the log after a checkpoint: (HEADER, random token) '''
+    HEADER = "H"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = FileLock(path)
+        self.records = 0
+        self.last_txid = 0
+        ''' header token, end of the last complete record and file size, as seen by this process '''
+        self.token = None
+        self.end = 0
+        self.size = 0
+        for txid, entries in self.read():
+            self.records += 1
+            self.last_txid = max(self.last_txid, txid)
+
+    def read(self):
+        ''' return list of (txid, [(table name, op, key, value)]) '''
+        self.token = None
+        self.end = 0
+        return self._scan()
+
+    def _scan(self):
+        ''' read records from self.end to the last complete one '''
+        records = []
+        self.size = 0
+        if not os.path.exists(self.path):
+            self.end = 0
+            return records
+        log_file = open(self.path, DBBase.DB_READ_FLAG)
+        try:
+            log_file.seek(self.end)
+            while True:
+                try:
+                    record = pickle.load(log_file)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, IndexError):
+                    ''' last record was not written completely - never committed '''
+                    break
+                self.end = log_file.tell()
+                if record[0] == CommitLog.HEADER:
+                    self.token = record[1]
+                else:
+                    records.append(record)
+            self.size = os.fstat(log_file.fileno()).st_size
+        finally:
+            log_file.close()
+        return records
+
+    def _read_token(self):
+        try:
+            log_file = open(self.path, DBBase.DB_READ_FLAG)
+        except IOError:
+            return None
+        try:
+            try:
+                record = pickle.load(log_file)
+            except Exception:
+                return None
+        finally:
+            log_file.close()
+        if record[0] == CommitLog.HEADER:
+            return record[1]
+        return None
+
+    def _truncate_torn(self):
+        ''' cut off a record half written by a crashed commit (the log lock is held) '''
+        size = os.path.exists(self.path) and os.path.getsize(self.path) or 0
+        if size == self.size:
+            return
+        if size < self.end or self._read_token() != self.token:
+            ''' checkpoint by another process '''
+            self.read()
+        else:
+            self._scan()
+        if self.size > self.end:
+            handles.release(self.path)
+            log_file = open(self.path, "r+b")
+            try:
+                log_file.truncate(self.end)
+            finally:
+                log_file.close()
+            self.size = self.end
+
+    def next_txid(self, last_txids=()):
+        ''' txid bigger than the last ones of this process and of the tables '''
+        self.last_txid = max([long(time.time() * 1000000), self.last_txid + 1] +
+                             [txid + 1 for txid in last_txids])
+        return self.last_txid
+
+    def append(self, txid, entries):
+        ''' the log lock is held '''
+        self._truncate_torn()
+        log_file = handles.append_file(self.path)
+        pickle.dump((txid, entries), log_file, pickle.HIGHEST_PROTOCOL)
+        log_file.flush()
+        os.fsync(log_file.fileno())
+        self.end = self.size = log_file.tell()
+        self.records += 1
+
+    def recover(self, store):
+        ''' apply committed transactions missing from the table file '''
+        with self.lock:
+            for txid, entries in self.read():
+                if txid <= store.last_txid:
+                    continue
+                table_entries = [(op, key, value) for name, op, key, value in entries
+                                 if name == store.name]
+                if table_entries:
+                    store._write(table_entries, txid)
+
+    def sync_tables(self, stores):
+        '''
+            sync the stores and the files of every table in the log - other
+            processes commit to tables this one has not opened (the log lock is held)
+        '''
+        for store in stores:
+            store.sync()
+        names = set([entry[0] for txid, entries in self.read() for entry in entries])
+        for name in names:
+            path = handles.resolve(name)
+            _sync_file(path)
+            if name in DBBase.SHARDED:
+                base, ext = os.path.splitext(path)
+                for index in range(conf.DB_SHARDS):
+                    _sync_file(ShardedStore.SHARD_NAME % (base, index, conf.DB_SHARDS, ext))
+
+    def checkpoint(self, stores):
+        ''' sync table files and drop the log when it gets too long '''
+        if self.records < CommitLog.CHECKPOINT_RECORDS:
+            return
+        with self.lock:
+            self.sync_tables(stores)
+            handles.release(self.path)
+            token = random.getrandbits(64)
+            log_file = open(self.path, DBBase.DB_WRITE_FLAG)
+            try:
+                pickle.dump((CommitLog.HEADER, token), log_file, pickle.HIGHEST_PROTOCOL)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+                self.end = self.size = log_file.tell()
+            finally:
+                log_file.close()
+            self.token = token
+            self.records = 0
+
+
+class Transaction(object):
+    """
+        Write to several tables in one commit:
+
+            with db.transaction():
+                wallet.save()
+                store.buy(product_name)
+
+        Writes made inside the block are staged and written together when the
+        block ends, or dropped if it raises. Reads of a staged key return the
+        staged value. A nested transaction joins the outer one.
+
+        Versions expected by the staged writes are checked at commit, with
+        the locks of all written tables held; on ConflictError nothing is
+        written.
+    """
+    local = threading.local()
+
+    def __init__(self):
+        self.entries = []
+        self.staged = {}
+        self.expected = {}
+        self.stores = []
+        self.depth = 0
+
+    @staticmethod
+    def current():
+        return getattr(Transaction.local, "transaction", None)
+
+    def __enter__(self):
+        outer = Transaction.current()
+        if outer is not None:
+            outer.depth += 1
+            return outer
+        self.depth = 1
+        Transaction.local.transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        tx = Transaction.current()
+        tx.depth -= 1
+        if tx.depth > 0:
+            return False
+        Transaction.local.transaction = None
+        if exc_type is None:
+            tx.commit()
+        return False
+
+    def stage(self, store, entries, expected=None):
+        if store not in self.stores:
+            self.stores.append(store)
+            self.expected[store] = {}
+        for op, key, value in entries:
+            self.entries.append((store, op, key, value))
+            self.staged[(store.name, key)] = (op, value)
+        for key, version in (expected or {}).items():
+            ''' version of the first read counts '''
+            self.expected[store].setdefault(key, version)
+
+    def is_staged(self, store, key):
+        return self.staged.has_key((store.name, key))
+
+    def get_staged(self, store, key, default=None):
+        op, value = self.staged[(store.name, key)]
+        if op == TableStore.OP_DELETE:
+            return default
+        return value
+
+    def entries_for(self, store):
+        return [(op, key, value) for s, op, key, value in self.entries if s is store]
+
+    def commit(self):
+        if not self.entries:
+            return
+        if isinstance(self.stores[0], SqliteStore):
+            ''' all sqlite tables share one connection - one sqlite commit '''
+            conn = self.stores[0].conn
+            conn.execute("PRAGMA synchronous=FULL")
+            try:
+                with conn:
+                    for store in self.stores:
+                        store._execute(self.entries_for(store), self.expected[store])
+            finally:
+                conn.execute("PRAGMA synchronous=NORMAL")
+        else:
+            log = DBBase.commit_log()
+            locks = [log.lock]
+            for store in self.stores:
+                locks.extend(store.locks([key for op, key, value in self.entries_for(store)]))
+            with LockGroup(locks):
+                for store in self.stores:
+                    store.refresh()
+                    store.check(self.expected[store])
+                txid = log.next_txid([store.newest_txid for store in self.stores])
+                log.append(txid, [(s.name, op, key, value) for s, op, key, value in self.entries])
+                for store in self.stores:
+                    store._write(self.entries_for(store), txid)
+            log.checkpoint(DBBase.stores.values())
+        self.entries, self.staged, self.expected, self.stores = [], {}, {}, []
+
+
+def transaction():
+    ''' start a transaction, use it in a 'with' statement '''
+    return Transaction()
+
+
+def dump_records(records, path):
+    ''' write records (any iterable) to a backup file one by one, return count '''
+    count = 0
+    backup = open(path, DBBase.DB_WRITE_FLAG)
+    try:
+        pickler = pickle.Pickler(backup, pickle.HIGHEST_PROTOCOL)
+        for record in records:
+            pickler.dump(record)
+            pickler.clear_memo()
+            count += 1
+    finally:
+        backup.close()
+    return count
+
+
+def load_records(path):
+    ''' read records written by dump_records, one at a time '''
+    backup = open(path, DBBase.DB_READ_FLAG)
+    try:
+        unpickler = pickle.Unpickler(backup)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                break
+    finally:
+        backup.close()
+
+
+class Snapshots(object):
+    """
+        Consistent copies of all tables, for point-in-time restore and for
+        repair of table files broken by a crash.
+
+        A snapshot is a directory <db dir>/snapshots/<ms time>/ with one
+        record stream per table (see dump_records), the same for both
+        backends. take() holds the locks of all tables and of the commit
+        log (pickle backend) or reads in one sqlite transaction, so no
+        commit is half in it; it is written to a temporary directory and
+        renamed when complete.
+    """
+    DIR = "snapshots"
+    TMP_SUFFIX = ".tmp"
+    ''' unfinished snapshot not changed for so long was left by a crashed game '''
+    TMP_STALE_SECONDS = 3600
+
+    def directory(self):
+        return os.path.join(os.path.dirname(handles.resolve(Account.DB)), Snapshots.DIR)
+
+    def path(self, when):
+        return os.path.join(self.directory(), "%d" % when)
+
+    def times(self):
+        ''' times of complete snapshots (ms since 1970), oldest first '''
+        directory = self.directory()
+        if not os.path.isdir(directory):
+            return []
+        return sorted([long(name) for name in os.listdir(directory) if name.isdigit()])
+
+    def _stores(self):
+        return [DBBase()._get_store(name) for name in sorted(RECORD_CLASSES.keys())]
+
+    @contextlib.contextmanager
+    def _consistent(self, stores):
+        ''' keep writers out while all the stores are read '''
+        if isinstance(stores[0], SqliteStore):
+            conn = stores[0].conn
+            ''' sqlite3 module must not begin or commit on its own meanwhile '''
+            isolation_level, conn.isolation_level = conn.isolation_level, None
+            conn.execute("BEGIN")
+            try:
+                yield
+            finally:
+                conn.execute("COMMIT")
+                conn.isolation_level = isolation_level
+        else:
+            locks = [DBBase.commit_log().lock]
+            for store in stores:
+                locks.extend(store.locks())
+            with LockGroup(locks):
+                for store in stores:
+                    store.refresh()
+                yield
+
+    def take(self, keep=None):
+        ''' write a snapshot of all tables, keep only the newest ones; return its time '''
+        '''
+            flush before the locks are taken: the flusher thread holds the
+            buffer lock while it waits for table locks, so the tables are
+            read without the buffer (later writes are not in the snapshot)
+        '''
+        buffer.flush()
+        stores = self._stores()
+        when = long(time.time() * 1000)
+        while os.path.exists(self.path(when)):
+            when += 1
+        tmp_path = self.path(when) + Snapshots.TMP_SUFFIX
+        os.makedirs(tmp_path)
+        try:
+            with self._consistent(stores):
+                for store in stores:
+                    dump_records(store._iter_items(), os.path.join(tmp_path, store.name))
+        except:
+            shutil.rmtree(tmp_path, True)
+            raise
+        os.rename(tmp_path, self.path(when))
+        if keep:
+            self.prune(keep)
+        return when
+
+    def take_if_older(self, seconds, keep=None):
+        ''' take a snapshot if the last one is older than seconds, return its time or None '''
+        times = self.times()
+        if times and times[-1] > (time.time() - seconds) * 1000:
+            return None
+        return self.take(keep)
+
+    def prune(self, keep):
+        ''' remove all but the newest keep snapshots (and stale unfinished ones) '''
+        for when in self.times()[:-keep]:
+            shutil.rmtree(self.path(when), True)
+        directory = self.directory()
+        stale = time.time() - Snapshots.TMP_STALE_SECONDS
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith(Snapshots.TMP_SUFFIX):
+                continue
+            try:
+                ''' another game may be writing it '''
+                if os.path.getmtime(path) > stale:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(path, True)
+
+    def restore(self, when=None):
+        '''
+            bring all tables back to the newest snapshot taken at or before
+            when (ms since 1970, None - newest snapshot), in one transaction.
+            return time of the restored snapshot.
+        '''
+        times = [t for t in self.times() if when is None or t <= when]
+        if not times:
+            raise ValueError, "no snapshot taken before %s" % when
+        path = self.path(times[-1])
+        buffer.flush()
+        stores = [store for store in self._stores()
+                  if os.path.exists(os.path.join(path, store.name))]
+        with transaction():
+            for store in stores:
+                records = dict(load_records(os.path.join(path, store.name)))
+                entries = [(TableStore.OP_DELETE, key, None) for key in store.keys()
+                           if not records.has_key(key)]
+                entries.extend([(TableStore.OP_SET, key, value) for key, value in records.items()])
+                store.write(entries)
+        for store in stores:
+            if not isinstance(store, SqliteStore):
+                store.compact()
+        return times[-1]
+
+    def repair(self, store):
+        '''
+            write back records of set aside table files from the newest
+            snapshot, return number of records. later writes are recovered
+            from the commit log, if it still has them.
+        '''
+        count = 0
+        times = self.times()
+        path = times and os.path.join(self.path(times[-1]), store.name)
+        if path and os.path.exists(path):
+            entries = [(TableStore.OP_SET, key, value) for key, value in load_records(path)
+                       if store.is_damaged(key) and not store.has_key(key)]
+            if entries:
+                store._write(entries)
+            count = len(entries)
+        store.repaired()
+        return count
+
+snapshots = Snapshots()
+
+
+class TimeoutError(Exception):
+    ''' Future.result() waited longer than timeout '''
+    pass
+
+
+class Future(object):
+    """
+        Result of a call running in the db worker thread (see submit()).
+
+        result() waits for the call and returns its value, or raises the
+        exception raised by the call. Nobody waits for a call started by
+        post(), its exception is printed instead.
+    """
+    def __init__(self, report=False):
+        self.finished = threading.Event()
+        self.value = None
+        self.error = None
+        self.report = report
+
+    def set_result(self, value):
+        self.value = value
+        self.finished.set()
+
+    def set_exception(self, exc_info):
+        self.error = exc_info
+        self.finished.set()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        if not self.finished.wait(timeout):
+            raise TimeoutError, "db call not finished in %s s" % timeout
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+    def exception(self, timeout=None):
+        if not self.finished.wait(timeout):
+            raise TimeoutError, "db call not finished in %s s" % timeout
+        if self.error is not None:
+            return self.error[1]
+        return None
+
+
+class Worker(object):
+    """
+        Background thread running db calls one by one, in submit order, so
+        a later call sees the writes of the earlier ones. The thread starts
+        with the first call; stop() runs the calls left in the queue first.
+    """
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        return self.call(Future(), fn, args, kwargs)
+
+    def post(self, fn, *args, **kwargs):
+        return self.call(Future(report=True), fn, args, kwargs)
+
+    def call(self, future, fn, args, kwargs):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="db-worker")
+                self.thread.daemon = True
+                self.thread.start()
+            self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            future, fn, args, kwargs = job
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except:
+                future.set_exception(sys.exc_info())
+                if future.report:
+                    print >> sys.stderr, "db: %s failed in background:\n%s" % (
+                        getattr(fn, "__name__", fn), "".join(traceback.format_exception(*future.error)))
+
+    def stop(self):
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+worker = Worker()
+''' registered after buffer.flush and handles.close - runs (and writes) before them at exit '''
+atexit.register(worker.stop)
+
+
+def submit(fn, *args, **kwargs):
+    ''' run fn(*args, **kwargs) in the db worker thread, return Future '''
+    return worker.submit(fn, *args, **kwargs)
+
+def post(fn, *args, **kwargs):
+    ''' like submit() when nobody is going to wait for the result - an exception is printed '''
+    return worker.post(fn, *args, **kwargs)
+
+
+def close():
+    ''' finish background calls, close all db files and connections, tables are reopened on next use '''
+    worker.stop()
+    buffer.flush()
+    DBBase.invalidate()
+    handles.close()
+
+def use_directory(path=None):
+    ''' close the db and keep tables in path from now on (None - data directories again) '''
+    close()
+    DBBase.log = None
+    handles.paths = {}
+    handles.directory = path
+
+
 class DBBase(object):
 
     DB_WRITE_FLAG = "wb"
     DB_READ_FLAG = "rb"
+    DB_APPEND_FLAG = "ab"
     DB_DIR = "db"
+    ''' records written at once by bulk imports '''
+    BULK_CHUNK = 1000
+    ''' per player tables, split in shards by uid (pickle backend) '''
+    SHARDED = ("wallet.db", "store.db")
+    ''' tables saved through the write-behind buffer (see WriteBuffer) '''
+    WRITE_BEHIND = ("wallet.db", "store.db", "landings.db", "leaderboard.db")
+
+    ''' opened tables shared by all instances (and threads): table name -> store '''
+    stores = {}
+    stores_lock = threading.RLock()
+    ''' transaction log of the pickle backend, opened on first use '''
+    log = None
 
     def generate_id(self, tip=None):
         '''
-            generate unique ID
+            generate unique ID (tip is not used anymore, ids are time ordered)
         '''
-        current_time = long(round(time.time() * 1000))
-        if tip is None:
-            tip = random.random()
-        rnd = "%s%s" % (str(current_time), str(tip))
-        return uuid.uuid5(uuid.NAMESPACE_DNS, rnd)
+        return ids.next_id()
 
     def get_id(self):
         return self.id
@@ -30,63 +1820,180 @@ class DBBase(object):
     def set_value(self, kwargs, value_name):
         if kwargs.has_key(value_name):
             return kwargs.get(value_name)
-        return None    
+        return None
 
     def _get_db(self, name):
-        dirs = read_directories(DBBase.DB_DIR)
-        self.db_name = get_path(name, dirs)
+        self.db_name = handles.resolve(name)
         return self.db_name
-    
+
+    def _get_store(self, name):
+        ''' return cached table store, open it on first use '''
+        store = DBBase.stores.get(name)
+        if store is None:
+            with DBBase.stores_lock:
+                store = DBBase.stores.get(name)
+                if store is None:
+                    store = self._open_store(name)
+                    DBBase.stores[name] = store
+                    return store
+        store.refresh()
+        return store
+
+    def _open_store(self, name):
+        if conf.DB_BACKEND == conf.DB_BACKEND_SQLITE:
+            store = SqliteStore(self._get_db(conf.DB_SQLITE_FILE), name,
+                                legacy=lambda: self._open_journal(name))
+        else:
+            store = self._open_journal(name)
+            if store.is_damaged():
+                snapshots.repair(store)
+            DBBase.commit_log().recover(store)
+        store.buffered = conf.DB_WRITE_BEHIND and name in DBBase.WRITE_BEHIND
+        return store
+
+    def _open_journal(self, name):
+        ''' table of the pickle backend, SHARDED tables are split in conf.DB_SHARDS files '''
+        if name in DBBase.SHARDED:
+            store = ShardedStore(self._get_db(name), name, conf.DB_SHARDS)
+            store.migrate()
+            return store
+        return JournalStore(self._get_db(name), name)
+
+    @staticmethod
+    def commit_log():
+        if DBBase.log is None:
+            with DBBase.stores_lock:
+                if DBBase.log is None:
+                    DBBase.log = CommitLog(DBBase()._get_db(CommitLog.NAME))
+        return DBBase.log
+
+    @staticmethod
+    def invalidate(name=None):
+        ''' drop cached table (or all tables), next access reloads from disk '''
+        buffer.flush()
+        if name is None:
+            DBBase.stores.clear()
+        else:
+            DBBase.stores.pop(name, None)
+
     def get_all(self):
         return NotImplemented
-    
+
     def save(self):
         return NotImplemented
 
+    def defer(self, method, *args, **kwargs):
+        '''
+            run a method of this object in the db worker thread, return Future:
+                wallet = db.Wallet(uid).defer("get")
+        '''
+        return submit(getattr(self, method), *args, **kwargs)
+
+    @staticmethod
+    def record_key(record):
+        ''' key of record in the table, tables with bulk import define it '''
+        raise NotImplementedError
+
+    ''' fields saved in the table, in record order (new fields go to the end) '''
+    FIELDS = ()
+
+    def to_record(self):
+        ''' record saved in the table: tuple of FIELDS values '''
+        return tuple([getattr(self, field, None) for field in self.FIELDS])
+
+    @classmethod
+    def from_record(cls, record):
+        ''' build object from a saved record (or from a pickled object of old tables) '''
+        if record is None:
+            return None
+        obj = cls.__new__(cls)
+        if isinstance(record, tuple):
+            values = list(record) + [None] * (len(cls.FIELDS) - len(record))
+            for field, value in zip(cls.FIELDS, values):
+                setattr(obj, field, value)
+        else:
+            for field in cls.FIELDS:
+                setattr(obj, field, getattr(record, field, None))
+        return obj
+
+    @classmethod
+    def import_stream(cls, records, chunk_size=None):
+        '''
+            save records from an iterable in one pass, BULK_CHUNK records
+            per write. return number of saved records.
+        '''
+        if chunk_size is None:
+            chunk_size = DBBase.BULK_CHUNK
+        store = DBBase()._get_store(cls.DB)
+        count = 0
+        chunk = []
+        for record in records:
+            chunk.append((cls.record_key(record), record.to_record()))
+            if len(chunk) >= chunk_size:
+                store.put_many(chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            store.put_many(chunk)
+            count += len(chunk)
+        return count
+
+    @classmethod
+    def export_stream(cls):
+        ''' iterate over all records of the table '''
+        record_class = RECORD_CLASSES[cls.DB]
+        for key, record in DBBase()._get_store(cls.DB).iter_items():
+            yield record_class.from_record(record)
+
 class Account(DBBase):
     DB = "users.db"
-    
+    FIELDS = ("id", "account", "name")
+
     def add_account(self, user_clazz):
-        self.accounts = self.load_accounts()
-        self.accounts.update({user_clazz.account : user_clazz})
-        
-        pickle_file = open(self._get_db(Account.DB), DBBase.DB_WRITE_FLAG)
-        pickle.dump(self.accounts, pickle_file, pickle.HIGHEST_PROTOCOL)
+        self._get_store(Account.DB).put(user_clazz.account, user_clazz.to_record())
 
     def load_accounts(self):
-        self.accounts = {}
-        pickle_file = open(self._get_db(Account.DB), DBBase.DB_READ_FLAG)
-        try:
-            self.accounts = pickle.load(pickle_file)
-        except EOFError:
-            pass         
+        self.accounts = dict([(account, User.from_record(record)) for account, record
+                              in self._get_store(Account.DB).iter_items()])
         return self.accounts
-            
+
+    @staticmethod
+    def record_key(user):
+        return user.account
+
+    @classmethod
+    def import_stream(cls, users, chunk_size=None):
+        ''' save users in one pass, users without id get one like in User.save() '''
+        def with_id(users):
+            for user in users:
+                if user.id is None:
+                    user.id = db_account.generate_id()
+                yield user
+        return super(Account, cls).import_stream(with_id(users), chunk_size)
+
 db_account = Account()
 class User(Account):
     def __init__(self, account=None, **kwargs):
         self.id = None
         self.account = account
         self.name = self.set_value(kwargs, "name")
-        
+
     def save(self):
         self.id = self.generate_id()
         db_account.add_account(self)
 
     def get_id(self):
         return self.id
-        
+
     def get_account(self, account):
-        user_accounts = db_account.load_accounts()
-        if user_accounts:
-            if user_accounts.has_key(account):
-                return user_accounts.get(account)
-        return None
-    
+        return User.from_record(self._get_store(Account.DB).get(account))
+
 class Product(DBBase):
     DB = "products.db"
     CURRENCY = "COINS"
-    
+    FIELDS = ("id", "name", "description", "photo", "price", "currency",
+              "ship", "shield", "fuelpack")
+
     def __init__(self, **kwargs):
         self.id = self.generate_id()
         self.name = self.set_value(kwargs, "name")
@@ -98,89 +2005,91 @@ class Product(DBBase):
             self.currency = Product.CURRENCY
 
     def get_all(self):
-        self.products = {}
-        pickle_file = open(self._get_db(Product.DB), DBBase.DB_READ_FLAG)
-        try:
-            self.products = pickle.load(pickle_file)
-        except EOFError:
-            pass         
+        self.products = dict([(name, Product.from_record(record)) for name, record
+                              in self._get_store(Product.DB).iter_items()])
         return self.products
-    
+
     def get(self, product_name):
-        products = self.get_all()
-        if products.has_key(product_name):
-            return products.get(product_name)
-        return None
-    
+        return Product.from_record(self._get_store(Product.DB).get(product_name))
+
     def to_list(self):
-        self.products = self.get_all()
-        return self.products.keys()
-    
+        return self._get_store(Product.DB).keys()
+
     def save(self):
         self.id = self.generate_id()
-        
-        self.products = self.get_all()
-        self.products.update({self.name : self})
-        
-        pickle_file = open(self._get_db(Product.DB), DBBase.DB_WRITE_FLAG)
-        pickle.dump(self.products, pickle_file, pickle.HIGHEST_PROTOCOL)
+        self._get_store(Product.DB).put(self.name, self.to_record())
+
+    @staticmethod
+    def record_key(product):
+        return product.name
+
+    @classmethod
+    def save_many(cls, products, chunk_size=None):
+        ''' save products in one pass instead of one save() per product '''
+        return cls.import_stream(products, chunk_size)
 
 
 
 class Wallet(DBBase):
     DB = "wallet.db"
-    
+
     EMPTY = "Your wallet is empty! Buy 100 Coins"
     COINS = "Coins"
     DEFAULT_COINS = 100
-    
+    CONFLICT = "Wallet was changed by another game, try again"
+    FIELDS = ("uid", "value")
+    ''' version of the record read by get(), None - not read '''
+    version = None
+
     def __init__(self, uid):
         self.value = 0
         self.uid = uid
+        self.version = None
 
     def get_all(self):
-        wallets = {}
-        pickle_file = open(self._get_db(Wallet.DB), DBBase.DB_READ_FLAG)
-        try:
-            wallets = pickle.load(pickle_file)
-        except EOFError:
-            pass         
-        return wallets   
+        return dict([(uid, Wallet.from_record(record)) for uid, record
+                     in self._get_store(Wallet.DB).iter_items()])
 
     def get(self):
-        wallets = self.get_all()
-        if wallets.has_key(self.uid):
-            self.wallet = wallets.get(self.uid)
+        store = self._get_store(Wallet.DB)
+        self.version = store.version(self.uid)
+        wallet = Wallet.from_record(store.get(self.uid))
+        if wallet is not None:
+            self.wallet = wallet
             self.value = self.wallet.value
             return self.wallet
         return None
-    
+
     def get_balance(self):
         return self.value
-    
+
     def set_total_coins(self, value):
         self.value = value
-    
+
     def add_coins(self, deposit=0):
         self.value += deposit
-            
+
     def substract_coins(self, debit=0):
         self.value -= debit
-    
+
     def get_payment(self, bill):
         payment_allowed = False
         if self.get_balance() > bill:
             self.substract_coins(bill)
             payment_allowed = True
         return payment_allowed
-    
+
     def save(self):
-        wallets = self.get_all()
-        wallets.update({self.uid : self})
-        pickle_file = open(self._get_db(Wallet.DB), DBBase.DB_WRITE_FLAG)
-        pickle.dump(wallets, pickle_file, pickle.HIGHEST_PROTOCOL)
-    
-    
+        ''' raise ConflictError if the wallet was saved by somebody else after get() '''
+        self._get_store(Wallet.DB).put(self.uid, self.to_record(), self.version)
+        if self.version is not None:
+            self.version += 1
+
+    @staticmethod
+    def record_key(wallet):
+        return wallet.uid
+
+
 class Store(DBBase):
     DB = "store.db"
 
@@ -189,59 +2098,198 @@ class Store(DBBase):
         self.id = None
         self.uid = uid
         self.product = None
-    
+
     def get_all(self):
-        products = {}
-        pickle_file = open(self._get_db(Store.DB), DBBase.DB_READ_FLAG)
-        try:
-            products = pickle.load(pickle_file)
-        except EOFError:
-            pass
-        return products
+        return dict([(uid, Product.from_record(record)) for uid, record
+                     in self._get_store(Store.DB).iter_items()])
 
     def get(self):
-        products = self.get_all()
-        if products.has_key(self.uid):
-            return products.get(self.uid)
-        return None
-    
+        return Product.from_record(self._get_store(Store.DB).get(self.uid))
+
     def add(self):
         self.id = self.generate_id()
-        products = self.get_all()
-        if products is None:
-            products = {}
-        products.update({self.uid : self.product })
-        self._save(products)
-    
-    def _save(self, data):
-        pickle_file = open(self._get_db(Store.DB), DBBase.DB_WRITE_FLAG)
-        pickle.dump(data, pickle_file, pickle.HIGHEST_PROTOCOL)
-    
+        record = None
+        if self.product is not None:
+            record = self.product.to_record()
+        self._get_store(Store.DB).put(self.uid, record)
+
     def get_product(self, item_name):
         if item_name is not None:
             self.product = Product().get(item_name)
             return self.product
         return None
-    
+
     def buy(self, item_name=None):
         if item_name is not None:
             self.product = Product().get(item_name)
             self.add()
-    
+
     def consume_item(self):
-        product = self.get()
+        store = self._get_store(Store.DB)
+        version = store.version(self.uid)
+        product = store.get(self.uid)
         if product is None:
             return None
-        products = self.get_all()
-        products.update({self.uid : None })
-        self._save(products)
-        return product
+        try:
+            store.put(self.uid, None, version)
+        except ConflictError:
+            ''' consumed (or replaced) by another game '''
+            return None
+        return Product.from_record(product)
+
+
+class Landing(DBBase):
+    """
+        Landing (or crash) of a player in a game session. The table keeps
+        the history of all games, records are never changed.
+    """
+    DB = "landings.db"
+    LANDED = "landed"
+    CRASHED = "crashed"
+    FIELDS = ("id", "uid", "session", "result", "points", "score", "time")
+
+    def __init__(self, uid, session, result=LANDED, points=0, score=0):
+        self.id = None
+        self.uid = uid
+        self.session = session
+        self.result = result
+        ''' points of this landing and score of the session after it '''
+        self.points = points
+        self.score = score
+        self.time = None
+
+    def save(self):
+        self.id = self.generate_id()
+        self.time = time.time()
+        self._get_store(Landing.DB).put(self.id, self.to_record())
+
+    def history(self, session=None):
+        ''' landings of the player (in one session), oldest first - index search with sqlite '''
+        store = self._get_store(Landing.DB)
+        if session is None:
+            records = store.find("uid", self.uid)
+        else:
+            records = store.find("session", session)
+        landings = [Landing.from_record(record) for key, record in records]
+        landings = [landing for landing in landings if landing.uid == self.uid]
+        landings.sort(key=lambda landing: landing.id)
+        return landings
+
+    @staticmethod
+    def record_key(landing):
+        return landing.id
+
+
+class Leaderboard(DBBase):
+    """
+        Top SIZE scores of a board, best first. submit() updates the board on
+        every score change, so reading it does not scan the landings history.
+
+        Entries are (score, time, key, account) tuples, key is the game
+        session on the SESSIONS board. A key keeps only its best score.
+    """
+    DB = "leaderboard.db"
+    SIZE = 10
+    SESSIONS = "sessions"
+    FIELDS = ("name", "entries")
+
+    def __init__(self, name=SESSIONS, size=None):
+        self.name = name
+        self.size = size or Leaderboard.SIZE
+        self.entries = ()
+        self.version = None
+
+    def get(self):
+        store = self._get_store(Leaderboard.DB)
+        self.version = store.version(self.name)
+        board = Leaderboard.from_record(store.get(self.name))
+        self.entries = board.entries if board is not None else ()
+        return self.entries
+
+    def top(self, count=None):
+        return list(self.get()[:count or self.size])
+
+    @staticmethod
+    def rank_key(entry):
+        ''' best score first, the older one first on the same score '''
+        return (-entry[0], entry[1])
+
+    def submit(self, key, score, account=None, when=None):
+        '''
+            put score of key on the board, return its rank (0 - best)
+            or None if the score is not good enough for the board
+        '''
+        if when is None:
+            when = time.time()
+        entry = (score, when, key, account)
+        while True:
+            entries = list(self.get())
+            for index, old in enumerate(entries):
+                if old[2] == key:
+                    if old[0] >= score:
+                        return index
+                    del entries[index]
+                    break
+            ranks = [Leaderboard.rank_key(old) for old in entries]
+            rank = bisect.bisect(ranks, Leaderboard.rank_key(entry))
+            if rank >= self.size:
+                return None
+            entries.insert(rank, entry)
+            self.entries = tuple(entries[:self.size])
+            try:
+                self._get_store(Leaderboard.DB).put(self.name, self.to_record(), self.version)
+            except ConflictError:
+                ''' board was changed by another game, merge again '''
+                continue
+            return rank
+
+
+''' table file -> class of its records '''
+RECORD_CLASSES = {
+    Account.DB: User,
+    Product.DB: Product,
+    Wallet.DB: Wallet,
+    Store.DB: Product,
+    Landing.DB: Landing,
+    Leaderboard.DB: Leaderboard,
+}
+
+def record_field(name, record, field):
+    ''' value of a record field, record is a tuple (or an object of old tables) '''
+    if isinstance(record, tuple):
+        fields = RECORD_CLASSES[name].FIELDS
+        if field not in fields or fields.index(field) >= len(record):
+            return None
+        return record[fields.index(field)]
+    return getattr(record, field, None)
+
+def upgrade():
+    '''
+        rewrite tables which still keep pickled objects as records,
+        return number of converted records. Old records are read as they
+        are (see from_record), so this is not run at start - it reads the
+        whole tables:
+            python -c "import db; print db.upgrade()"
+    '''
+    count = 0
+    for name, record_class in RECORD_CLASSES.items():
+        store = DBBase()._get_store(name)
+        legacy = [(key, record_class.from_record(value).to_record())
+                  for key, value in store.iter_items()
+                  if value is not None and not isinstance(value, tuple)]
+        if not legacy:
+            continue
+        store.put_many(legacy)
+        if not isinstance(store, SqliteStore):
+            store.compact()
+        count += len(legacy)
+    return count
 
 if __name__ == '__main__':
     product1 = Product(name="Blue Ship", description="super mega ship", photo="ship1.img", price="10")
     print "id: " + str(product1.get_id())
     product1.save()
-    
+
     product2 = Product(name="Megatron ship", description="Megathron blue ship", photo="ship2.img", price="15")
     print "id: " + str(product2.get_id())
     product2.save()
@@ -253,4 +2301,4 @@ if __name__ == '__main__':
     product4 = Product(name="Fuel Pack", description="Fuel ultra pack - 10 units", photo="fuel_pack.img", price="40")
     print "id: " + str(product4.get_id())
     product4.save()
-    
+
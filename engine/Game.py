@@ -23,6 +23,8 @@ class GameControl:
         self.events.add(Event.QUIT_Event(callback=self._quit))
         self.layers = []
         self.sprites = self.sprite_group()
+        ''' merges the dirty rects pushed by update() '''
+        self.dirty = Screen.DirtyRects(self.window.size)
         self.quit, self.stop = 0, 0
 
     def pause(self):
@@ -156,12 +158,15 @@ class Game(GameControl):
 
     def update(self, areas=None):
         """
-            update the display
+            update the display, areas (dirty rects of the frame) are merged
+            by self.dirty first
         """
         if areas is None:
             pygame.display.update()
         else:
-            pygame.display.update(areas)
+            self.dirty.update(areas)
+            if conf.DIRTY_STATS and self.dirty.frames % conf.MAX_FPS == 0:
+                print self.dirty.report()
 
     def if_key_pressed(self, key=K_RETURN, timeout=None):
         """
@@ -1,5 +1,6 @@
 import random
 import math
+import threading
 import pygame
 import pygame.draw
 from pygame.sprite import Sprite, RenderUpdates
@@ -12,6 +13,28 @@ from Utility import load_image
 from locals import WHITE, TRANSPARENT
 from locals import PI, PIx2
 
+''' Surface.blits is there since pygame 1.9.4 '''
+HAS_BLITS = hasattr(pygame.Surface, 'blits')
+
+def blits(surface, sequence):
+    """
+        blit (source, dest[, area]) pairs in one call, return their rects
+    """
+    if not sequence:
+        return []
+    if HAS_BLITS:
+        return surface.blits(sequence)
+    surface_blit = surface.blit
+    return [surface_blit(*args) for args in sequence]
+
+def bounds(rects):
+    """
+        smallest rect containing all the rects (empty rect for none)
+    """
+    if not rects:
+        return pygame.Rect(0, 0, 0, 0)
+    return pygame.Rect(rects[0]).unionall(rects)
+
 
 class SpriteGroup(RenderUpdates):
     def __init__(self, layer=None, sprites=[]):
@@ -64,9 +87,13 @@ class SpriteGroup(RenderUpdates):
         """
         levels = self.levels.keys()
         levels.sort()
+        bg = self.bg
+        areas = []
         for l in levels:
             level = self.levels[l]
-            RenderUpdates.clear(level, self.screen, self.bg)
+            areas.extend([(bg, r, r) for r in level.lostsprites])
+            areas.extend([(bg, r, r) for r in level.spritedict.itervalues() if r])
+        blits(self.screen, areas)
 
     def clear_layer(self):
         """Not used at this time.
@@ -88,34 +115,49 @@ class SpriteGroup(RenderUpdates):
         levels = self.levels.keys()
         levels.sort()
         for lvl in levels:
-            level = self.levels[lvl]
-            render += RenderUpdates.draw(level, self.screen)
+            render += self.levels[lvl].draw_level(self.screen)
         return render
 
-    def draw_visible(self, surface=None):
+    def draw_level(self, surface, visible=False):
         """
-            draw not hidden sprites
+            draw the sprites of this level (not hidden ones only if visible)
+            with one blits call, return the dirty rects
         """
-        if surface is None:
-            surface = self.screen
-
         spritedict = self.spritedict
-        surface_blit = surface.blit
         dirty = self.lostsprites
         self.lostsprites = []
         dirty_append = dirty.append
-        for s, r in spritedict.items():
-            if not s.hidden:
-                newrect = surface_blit(s.image, s.rect)
-                if r == 0:
-                    dirty_append(newrect)
-                else:
+        if visible:
+            sprites = []
+            for s, r in spritedict.iteritems():
+                if not s.hidden:
+                    sprites.append(s)
+                elif r:
+                    dirty_append(r)
+        else:
+            sprites = spritedict.keys()
+        rects = blits(surface, [(s.image, s.rect) for s in sprites])
+        for s, newrect in zip(sprites, rects):
+            r = spritedict[s]
+            if r:
+                if newrect.colliderect(r):
                     dirty_append(newrect.union(r))
-                spritedict[s] = newrect
-            elif r:
-                dirty_append(r)
+                else:
+                    dirty_append(newrect)
+                    dirty_append(r)
+            else:
+                dirty_append(newrect)
+            spritedict[s] = newrect
         return dirty
 
+    def draw_visible(self, surface=None):
+        """
+            draw not hidden sprites
+        """
+        if surface is None:
+            surface = self.screen
+        return self.draw_level(surface, visible=True)
+
     def move(self):
         levels = self.levels.keys()
         for lvl in levels:
@@ -447,6 +489,39 @@ class Graphics(Sprite):
         rects = [others[index] for index in indexes]
         return rects
 
+    def get_mask(self):
+        """return collision mask of the current image"""
+        return Utility.load_mask(self.image)
+
+    def collide_mask(self, other):
+        """return True if non transparent pixels of this sprite and
+            other sprite overlap. Masks are checked only if rects collide.
+            other: the other sprite to check for collision.
+        """
+        rect = self.rect
+        other_rect = other.rect
+        if not rect.colliderect(other_rect):
+            return 0
+        offset = (other_rect[0] - rect[0], other_rect[1] - rect[1])
+        return self.get_mask().overlap(other.get_mask(), offset) is not None
+
+    def collide_mask_any(self, others, rects=None, others_bounds=None):
+        """return the first of others whose non transparent pixels overlap
+            this sprite, or None. For static sprites (ground) keep their
+            rects and bounds() of them: a sprite out of the bounds is
+            rejected at once, else one Rect.collidelistall (faster in C
+            than a grid of ~100 rects) finds the sprites to check.
+        """
+        rect = self.rect
+        if others_bounds is not None and not others_bounds.colliderect(rect):
+            return None
+        if rects is None:
+            rects = [other.rect for other in others]
+        for index in rect.collidelistall(rects):
+            if self.collide_mask(others[index]):
+                return others[index]
+        return None
+
     def set_path(self, path):
         """set which path to follow """
         self.path = path
@@ -516,12 +591,9 @@ class Image(Graphics):
 
         if alpha:
             self.image.set_alpha(alpha, pygame.locals.RLEACCEL)
-            self.image.convert_alpha()
 
         if colorkey is not None:
-            self.image.set_colorkey(colorkey)
-            if not alpha:
-                self.image.convert()
+            self.image.set_colorkey(colorkey, pygame.locals.RLEACCEL)
 
         self.rect = self.image.get_rect()
         self.set_position((0, 0))
@@ -787,7 +859,7 @@ class MultipleObjects(Graphics):
         if image is None:
             image = load_image(filename, convert)
         if colorkey is not None:
-            image.set_colorkey(colorkey)
+            image.set_colorkey(colorkey, pygame.locals.RLEACCEL)
 
         self.images[filename] = image
         if self.defaultImage == 'None.png':
@@ -807,11 +879,62 @@ class MultipleObjects(Graphics):
         self.set_collision_rect()
 
         
+class RotatedFrames(dict):
+    """
+        Rotated images of one image by degrees. An image is made on first
+        access, together with its collision mask in masks.
+    """
+    def __init__(self, image, steps, colorkey=TRANSPARENT, convert=1):
+        dict.__init__(self)
+        degPerStep = 360 / steps
+        self.degrees = [int(step * degPerStep) for step in range(steps)]
+        if convert:
+            ''' rotated images keep the format of the image '''
+            image = Utility.convert_image(image, rle=0)
+        self.image = image
+        self.colorkey = colorkey
+        self.masks = {}
+
+    def __missing__(self, deg):
+        s = pygame.transform.rotate(self.image, deg)
+        s.set_colorkey(self.colorkey, pygame.locals.RLEACCEL)
+        ''' the mask goes first: a published image always has one '''
+        self.masks.setdefault(deg, Utility.load_mask(s))
+        return self.setdefault(deg, s)
+
+    def make_all(self):
+        for deg in self.degrees:
+            self[deg]
+
+
+def warm_up(frames, first=0):
+    """
+        make all images of the RotatedFrames in a background thread,
+        angles closest to first go first
+    """
+    def distance(deg):
+        return min(abs(deg - first), 360 - abs(deg - first))
+
+    def run():
+        for images in frames:
+            degrees = list(images.degrees)
+            degrees.sort(key=distance)
+            for deg in degrees:
+                images[deg]
+
+    thread = threading.Thread(target=run, name="rotation warm-up")
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+''' RotatedFrames of image files, shared by all sprites '''
+rotation_cache = {}
+
 class RotatedObject(MultipleObjects):
     """Sprite with auto-generated rotated images"""
 
     def __init__(self, w=None, filename=None, steps=4, image=None,
-                    colorkey=TRANSPARENT, convert=1, cx=None, cy=None):
+                    colorkey=TRANSPARENT, convert=1, cx=None, cy=None, lazy=0):
         """Initialize RotatedImage
 
         w: layer to draw in.
@@ -825,6 +948,7 @@ class RotatedObject(MultipleObjects):
             upper left corner of the image.
         cy: y-coordinate of center of rotation relative to the
             upper left corner of the image.
+        lazy: boolean, 1 = rotate an image when it is shown the first time
         """
         MultipleObjects.__init__(self, w=w,
                                 colorkey=colorkey,
@@ -832,71 +956,75 @@ class RotatedObject(MultipleObjects):
                                 )
         if image is None and filename is None:
             raise TypeError, 'Must include filename or image'
-        elif image is not None:
-            self.add(
-                     filename='image',
-                     image=image,
-                     colorkey=colorkey, convert=convert
-                     )
-        if image is None:
-            self.add(
-                     filename,
-                     colorkey=colorkey,
-                     convert=convert
-                     )
 
         self.set_rotation(0)
         self.set_rotationRate(0)
 
-        name, image = self.images.items()[0]
-        if cx is not None or cy is not None:
-            w, h = image.get_size()
-            if cx is None:
-                cx = w / 2.0
-            if cy is None:
-                cy = h / 2.0
-
-            if cx > w:
-                wnew = 2 * cx
-                x = 0
-            elif cx < 0:
-                wnew = (2 * w) + (2 * abs(cx))
-                x = w + (2 * -cx)
+        key = None
+        if image is None:
+            key = (filename, steps, colorkey, convert, cx, cy)
+        if rotation_cache.has_key(key):
+            self.images = rotation_cache[key]
+        else:
+            if image is not None:
+                self.add(
+                         filename='image',
+                         image=image,
+                         colorkey=colorkey, convert=convert
+                         )
             else:
-                wnew = (2 * w) - (2 * cx)
-                x = w - (2 * cx)
+                self.add(
+                         filename,
+                         colorkey=colorkey,
+                         convert=convert
+                         )
+
+            name, image = self.images.items()[0]
+            if cx is not None or cy is not None:
+                w, h = image.get_size()
+                if cx is None:
+                    cx = w / 2.0
+                if cy is None:
+                    cy = h / 2.0
+
+                if cx > w:
+                    wnew = 2 * cx
+                    x = 0
+                elif cx < 0:
+                    wnew = (2 * w) + (2 * abs(cx))
+                    x = w + (2 * -cx)
+                else:
+                    wnew = (2 * w) - (2 * cx)
+                    x = w - (2 * cx)
+
+                if cy > h:
+                    hnew = 2 * cy
+                    y = 0
+                elif cy < 0:
+                    hnew = (2 * h) + (2 * abs(cy))
+                    y = h + (2 * -cy)
+                else:
+                    hnew = (2 * h) - (2 * cy)
+                    y = h - (2 * cy)
 
-            if cy > h:
-                hnew = 2 * cy
-                y = 0
-            elif cy < 0:
-                hnew = (2 * h) + (2 * abs(cy))
-                y = h + (2 * -cy)
-            else:
-                hnew = (2 * h) - (2 * cy)
-                y = h - (2 * cy)
+                wnew = int(wnew)
+                hnew = int(hnew)
 
-            wnew = int(wnew)
-            hnew = int(hnew)
+                i = pygame.Surface((wnew, hnew))
+                i.fill(colorkey)
+                i.blit(image, (x, y))
+                i.set_colorkey(colorkey)
+                image = i
 
-            i = pygame.Surface((wnew, hnew))
-            i.fill(colorkey)
-            i.blit(image, (x, y))
-            i.set_colorkey(colorkey)
-            image = i
+            self.delete(name)
+            self.images = RotatedFrames(image, steps, colorkey, convert)
+            if key is not None:
+                rotation_cache[key] = self.images
+        self.masks = self.images.masks
+        if not lazy:
+            self.images.make_all()
 
-        degPerStep = 360 / steps
-        for step in range(steps):
-            deg = step * degPerStep
-            s = pygame.transform.rotate(image, deg)
-            s.set_colorkey(colorkey)
-            if convert:
-                s.convert()
-            self.images[int(deg)] = s
-        self.delete(name)
-
-        self.keys = list(self.images.keys())
-        self.keys.sort()
+        self.keys = list(self.images.degrees)
 
         self.flip(0)
         self.set_collision_rect(self.image.get_rect())
@@ -930,16 +1058,6 @@ class RotatedObject(MultipleObjects):
                 y = height - (2 * coord_y)
             return [new_width, new_height, x, y]
     
-    def rotate_objects_steps(self, image, steps, color, convert):
-        degPerStep = 360 / steps
-        for step in range(steps):
-            deg = step * degPerStep
-            s = pygame.transform.rotate(image, deg)
-            s.set_colorkey(color)
-            if convert:
-                s.convert()
-            self.images[int(deg)] = s
-
     def rotate(self, rad=None):
         """rotate to the left by radians"""
 
@@ -1009,7 +1127,7 @@ class RotatedObject(MultipleObjects):
 
         direction_image = self.get_rotation()
         obj = int(
-                (direction_image / PIx2) * len(self.images)
+                (direction_image / PIx2) * len(self.keys)
                 )
         self.set_image(obj)
         self.set_position(self.get_position())
@@ -1020,6 +1138,7 @@ class RotatedObject(MultipleObjects):
                  The keys are the rotation of the images.
         """
         self.image = self.images[self.keys[key]]
+        self.mask = self.masks[self.keys[key]]
         size = self.image.get_size()
         width, height = size
 
@@ -1027,6 +1146,14 @@ class RotatedObject(MultipleObjects):
         self.cx, self.cy = (width), (height / 2.0)
         self.set_collision_rect()
 
+    def get_mask(self):
+        """return collision mask of the current image, made with the image"""
+        return self.mask
+
+    def warm_up(self):
+        """make the images not shown yet in a background thread"""
+        return warm_up([self.images], math.degrees(self.get_rotation()))
+
     def move(self):
         if self.rotationRate:
             ticks = conf.ticks
@@ -1038,7 +1165,7 @@ class MultiRotated(RotatedObject):
     """Sprite with multiple auto-generated rotated images"""
 
     def __init__(self, w=None, filenames=None, steps=4,
-                    colorkey=TRANSPARENT, convert=1, cx=None, cy=None):
+                    colorkey=TRANSPARENT, convert=1, cx=None, cy=None, lazy=0):
         """Initialize MultiRotated
 
         @param w: L{Screen.Layer} to draw in.
@@ -1051,15 +1178,16 @@ class MultiRotated(RotatedObject):
             upper left corner of the image.
         @param cy: y-coordinate of center of rotation relative to the
             upper left corner of the image.
+        @param lazy: boolean, 1 = rotate an image when it is shown the first time
 
         """
         RotatedObject.__init__(self, w=w, filename=filenames[0], steps=steps,
-                            colorkey=colorkey, convert=convert, cx=cx, cy=cy)
+                            colorkey=colorkey, convert=convert, cx=cx, cy=cy, lazy=lazy)
         self._images = {}
 
         for f in filenames:
             ri = RotatedObject(w=w, filename=f, steps=steps,
-                    colorkey=colorkey, convert=convert, cx=cx, cy=cy)
+                    colorkey=colorkey, convert=convert, cx=cx, cy=cy, lazy=lazy)
             self._images[f] = ri
 
         self._images_keys = list(filenames)
@@ -1091,6 +1219,12 @@ class MultiRotated(RotatedObject):
         """
         self.keys = self._images[f].keys
         self.images = self._images[f].images
+        self.masks = self._images[f].masks
+
+    def warm_up(self):
+        """make the images not shown yet of all sets in a background thread"""
+        frames = [self._images[f].images for f in self._images_keys]
+        return warm_up(frames, math.degrees(self.get_rotation()))
 
     def flip_images(self):
         """flip to the next set of images."""
@@ -1102,6 +1236,7 @@ class MultiRotated(RotatedObject):
         key = self._images_keys[idx]
         self.keys = self._images[key].keys
         self.images = self._images[key].images
+        self.masks = self._images[key].masks
         self._images_key_idx = idx
 
     def move(self):
@@ -1130,6 +1265,9 @@ class StaticObject(Graphics):
         """set image to both background and foreground."""
         rect = self.rect
         self.window.bg.blit(self.image, rect)
+        if self.window.scene is not None:
+            ''' screen is updated once for the whole scene '''
+            return
         self.window.screen.blit(self.image, rect)
         pygame.display.update(rect)
 
@@ -1144,6 +1282,8 @@ class StaticObject(Graphics):
         weight, height = self.rect.size
         r = pygame.Rect(0, 0, weight, height)
         self.window.bg.blit(self.bg, self.rect, r)
+        if self.window.scene is not None:
+            return
         self.window.screen.blit(self.bg, self.rect, r)
         pygame.display.update(self.rect)
 
@@ -7,7 +7,109 @@ from Utility import load_image
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 
+class DirtyRects:
+    """
+        Dirty rects of a frame, merged before they are pushed to the display.
+
+        Overlapping or touching rects are replaced by their union, so a
+        sprite drawn over another (or moving by a few pixels) is pushed
+        once. When the merged rects cover more than full_ratio of the
+        screen the whole display is flipped instead, one big copy is
+        cheaper than many small ones.
+
+        rects, pixels and full describe the last pushed frame.
+    """
+    FULL_RATIO = 0.5
+
+    def __init__(self, size=None, full_ratio=None):
+        if size is None:
+            size = conf.WINSIZE
+        if full_ratio is None:
+            full_ratio = DirtyRects.FULL_RATIO
+        self.screen_rect = pygame.Rect((0, 0), size)
+        self.full_ratio = full_ratio
+        self.rects = 0
+        self.pixels = 0
+        self.full = False
+        self.frames = 0
+
+    def merge(self, rects):
+        """ return list of rects, overlapping and touching rects joined """
+        merged = []
+        screen_rect = self.screen_rect
+        for rect in rects:
+            rect = screen_rect.clip(rect)
+            if not rect.width or not rect.height:
+                continue
+            ''' union may touch rects merged before - repeat until it is alone '''
+            index = rect.inflate(2, 2).collidelist(merged)
+            while index != -1:
+                rect.union_ip(merged.pop(index))
+                index = rect.inflate(2, 2).collidelist(merged)
+            merged.append(rect)
+        return merged
+
+    def update(self, rects):
+        """ push the frame to the display, return pushed rects (screen rect if flipped) """
+        merged = self.merge(rects)
+        pixels = 0
+        for rect in merged:
+            pixels += rect.width * rect.height
+        self.frames += 1
+        if pixels > self.full_ratio * self.screen_rect.width * self.screen_rect.height:
+            pygame.display.flip()
+            self.rects, self.pixels, self.full = 1, self.screen_rect.width * self.screen_rect.height, True
+            return [self.screen_rect]
+        if merged:
+            pygame.display.update(merged)
+        self.rects, self.pixels, self.full = len(merged), pixels, False
+        return merged
+
+    def report(self):
+        area = self.screen_rect.width * self.screen_rect.height
+        return "frame %d: %d rects, %d pixels (%.1f%%)%s" % (
+            self.frames, self.rects, self.pixels, 100.0 * self.pixels / area,
+            self.full and ", full update" or "")
+
+
+class StaticScene:
+    """
+        Bake static elements (stars, planets, ground) into the window
+        background in one pass:
+
+            with StaticScene(window):
+                window.set_background(color=BLACK)
+                StaticObject(window, star).draw()
+                ...
+
+        While the scene is open the window and static objects draw on the
+        background only; when it is closed the background is copied to the
+        screen with one blit and the display is updated once, instead of
+        one update per object. Nested scenes join the outer one.
+    """
+    def __init__(self, window=None):
+        if window is None:
+            window = conf.window
+        self.window = window
+        self.outer = None
+
+    def __enter__(self):
+        self.outer = self.window.scene
+        if self.outer is None:
+            self.window.scene = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.outer is None:
+            self.window.scene = None
+            self.window.clear()
+        return False
+
+
 class Canvas:
+    ''' open StaticScene - screen is redrawn when it is closed '''
+    scene = None
+
     def __init__(self, size=None):
         if size is None:
             size = conf.WINSIZE
@@ -50,7 +152,8 @@ class Canvas:
             self._background.blit(background, (0, 0))
         else:
             self._background = background
-        self._foreground.blit(self._background, (0, 0))            
+        if self.scene is None:
+            self._foreground.blit(self._background, (0, 0))
         
 
     def set_border(self, width=1, color=WHITE,
@@ -167,6 +270,8 @@ class Window(Canvas):
 
     def clear(self):
         """ clear the screen """
+        if self.scene is not None:
+            return
         Canvas.clear(self)
         pygame.display.update()
 
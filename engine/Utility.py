@@ -1,7 +1,9 @@
 import pygame
+import pygame.mask
 import sys
 import os
 import traceback
+import weakref
 import conf
 from engine.locals import *
 
@@ -81,15 +83,45 @@ def read_directories(type=None):
         directory_cache[type] = dir_list
         return dir_list
 
-def convert_to_alpha_mask(image):
-    alpha_mask = image.get_masks()
-    if not alpha_mask:
+def set_rle(image):
+    """
+        RLE encode the image (by per pixel alpha or colorkey) on first blit.
+        Locking a RLE image decodes and encodes it again, so not for images
+        which are drawn into or read pixel by pixel
+    """
+    if image.get_flags() & pygame.SRCALPHA:
+        image.set_alpha(255, pygame.RLEACCEL)
+    elif image.get_colorkey() is not None:
+        image.set_colorkey(image.get_colorkey(), pygame.RLEACCEL)
+
+def convert_image(image, rle=1):
+    """
+        copy of the image in display format - convert_alpha for images with
+        per pixel alpha, convert for the rest - RLE encoded if rle.
+        There is no display format before the display is set, the image is
+        returned as it is
+    """
+    if pygame.display.get_surface() is None:
+        return image
+    if image.get_flags() & pygame.SRCALPHA:
+        image = image.convert_alpha()
+    else:
         image = image.convert()
+    if rle:
+        set_rle(image)
     return image
 
 image_cache = {}
+''' (filename, display format) -> image converted to that format '''
+display_image_cache = {}
 DEFAULT_IMAGE_DIR = "images"
 def load_image(filename, convert=1):
+    '''
+        files are loaded once per process. Rotated frames (Graphics.RotatedFrames)
+        are made in memory, not kept on disk as sprite sheets: loading and
+        slicing a sheet of 60 lander frames took 5.5 (raw) to 20.6 ms (PNG),
+        rotating them again 4.0 ms, and a sheet is 2.7 MB per skin
+    '''
     global image_cache
 
     if image_cache.has_key(filename):
@@ -103,11 +135,34 @@ def load_image(filename, convert=1):
             raise pygame.error, 'Could not load %s' % filename
         image_cache[filename] = image
 
-    if convert:
-        image = convert_to_alpha_mask(image)
+    display = pygame.display.get_surface()
+    if convert and display is not None:
+        key = (filename, display.get_bitsize(), display.get_masks())
+        if not display_image_cache.has_key(key):
+            display_image_cache[key] = convert_image(image)
+        image = display_image_cache[key]
     return image
 
 
+mask_cache = weakref.WeakKeyDictionary()
+def load_mask(image):
+    """
+        collision mask of the image, made once per surface.
+        from_surface prefers the colorkey to per pixel alpha, so images
+        with alpha are masked from a copy without the colorkey
+    """
+    if mask_cache.has_key(image):
+        return mask_cache[image]
+    if image.get_colorkey() is not None and image.get_flags() & pygame.SRCALPHA:
+        plain = image.copy()
+        plain.set_colorkey(None)
+        mask = pygame.mask.from_surface(plain)
+    else:
+        mask = pygame.mask.from_surface(image)
+    mask_cache[image] = mask
+    return mask
+
+
 def load_images(filenames=None, dirname=None, convert=1):
     if filenames is None and dirname is None:
         raise TypeError, 'must specify firname or filenames'
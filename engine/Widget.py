@@ -223,8 +223,11 @@ class MenuActionHandler(object):
         self.bg = image.load(bg_filename).convert()
         self.title = title
         self.menus = []
+        ''' index of the store products menu (see set_store_menu) '''
+        self.store_menu = None
         self.actions = {}
         self.user = None
+        self.wallet = None
     
     def set_user(self, user):
         self.user = user
@@ -240,9 +243,81 @@ class MenuActionHandler(object):
     
     def get_menu(self, idx):
         try:
-            return self.menus[idx]
+            menu = self.menus[idx]
         except ValueError:
             raise pygame.error 
+        if isinstance(menu["menu"], db.Future):
+            ''' menu items loaded in background (store products) '''
+            menu["menu"] = self.wait(menu["menu"])
+        elif callable(menu["menu"]):
+            ''' menu items loaded on first use '''
+            menu["menu"] = menu["menu"]()
+        return menu
+
+    def set_store_menu(self, idx):
+        ''' menu idx lists store products, its items are loaded when the store is opened '''
+        self.store_menu = idx
+
+    def get_store_items(self):
+        ''' store menu items - empty until the store menu was shown '''
+        if self.store_menu is None or not isinstance(self.menus[self.store_menu]["menu"], list):
+            return []
+        return self.menus[self.store_menu]["menu"]
+
+    def load_store(self):
+        ''' start loading store products in db worker, the first time the store is opened '''
+        menu = self.menus[self.store_menu]
+        if callable(menu["menu"]):
+            menu["menu"] = db.submit(menu["menu"])
+
+    def preload(self):
+        ''' start loading user wallet in db worker '''
+        if self.user is not None:
+            self.wallet = db.Wallet(self.user.id).defer("get")
+
+    def wait(self, future):
+        ''' wait for a db call running in background, window keeps handling events '''
+        while not future.done():
+            event.pump()
+            time.wait(10)
+        return future.result()
+
+    def buy(self, product_name):
+        '''
+            pay for item (or coins) and save it in user store, runs in db worker.
+            return message to show or None
+        '''
+        wallet = db.Wallet(self.user.id)
+        user_wallet = wallet.get()
+        try:
+            if user_wallet is None:
+                ''' maybe, user wants to buy 100 coins = 2USD '''
+                if Wallet.COINS in product_name:
+                    wallet.set_total_coins(Wallet.DEFAULT_COINS)
+                    wallet.save()
+                return Wallet.EMPTY
+            ''' user wants to buy 100 coins = 2USD '''
+            if Wallet.COINS in product_name:
+                wallet.add_coins(Wallet.DEFAULT_COINS)
+                wallet.save()
+                return None
+            ''' user wants to buy some item(s) '''
+            if wallet.get_balance() == 0:
+                return Wallet.EMPTY
+            store = db.Store(self.user.id)
+            product = store.get_product(product_name)
+            if product:
+                ''' check if user has enough coins to buy a item from store '''
+                if not wallet.get_payment(int(product.price)):
+                    return Wallet.EMPTY
+                ''' pay and save product in user store - both or nothing '''
+                with db.transaction():
+                    wallet.save()
+                    store.buy(product_name)
+        except db.ConflictError:
+            ''' wallet was saved by another game since it was read - nothing was paid '''
+            return Wallet.CONFLICT
+        return None
     
     def set_action(self, item_name, package, clazz):
         self.actions[item_name] = { package : clazz }
@@ -252,7 +327,6 @@ class MenuActionHandler(object):
             return self.actions.get(item_name)
     
     def show(self):
-        from main import PRODUCTS
         time.Clock()
 
         mainmenu = self.font.render(self.title, 1, (255,255,255) )
@@ -263,6 +337,8 @@ class MenuActionHandler(object):
         bg = self.screen.copy()
         self.screen.blit(mainmenu, rect_title)
         display.flip()
+        ''' db reads run in background while the menu is animated '''
+        self.preload()
         
         resp = MenuActionHandler.ACTION_SHOW
         while resp == MenuActionHandler.ACTION_SHOW:
@@ -273,12 +349,13 @@ class MenuActionHandler(object):
         while show_menu:
             ''' show store submenu and render items on screen '''    
             if resp[0] == MenuActionHandler.ACTION_STORE:
-                ''' get user balance '''
-                wallet = db.Wallet(self.user.id)
-                user_wallet = wallet.get()
+                self.load_store()
+                ''' get user balance (loaded in background) '''
+                user_wallet = self.wait(self.wallet)
+                self.wallet = db.Wallet(self.user.id).defer("get")
                 balance = 0
                 if user_wallet:
-                    balance = wallet.get_balance()
+                    balance = user_wallet.get_balance()
                 ''' set menu title and display user balance '''
                 menu_title = ("%s - %s coins") % (MenuActionHandler.ACTION_STORE, str(balance)) 
                 display.update(self.screen.blit(self.bg, (0, 0) ))
@@ -286,57 +363,20 @@ class MenuActionHandler(object):
                                                 self.font.render(menu_title, 1, (255,255,255)), (450, 450)
                                                 )
                                )
-                menu = Menu(screen=self.screen, bg=bg, **self.get_menu(1))
+                menu = Menu(screen=self.screen, bg=bg, **self.get_menu(self.store_menu))
                 resp = menu.render()
             
             ''' user wants to buy something from store '''
-            if resp[0] in PRODUCTS:
-                product_name = resp[0]
-                uid = self.user.id
-                ''' check if user has enough coins to buy an item from store '''
-                wallet = db.Wallet(uid)
-                user_wallet = wallet.get()
-                if user_wallet is None:
-                    ''' if user wallet is empty then show error '''
+            if resp[0] in self.get_store_items():
+                ''' pay in background, window keeps handling events '''
+                message = self.wait(db.submit(self.buy, resp[0]))
+                self.wallet = db.Wallet(self.user.id).defer("get")
+                if message:
                     display.update(self.screen.blit(self.bg, (0,0) ))
                     display.update(self.screen.blit(
-                                                    self.font2.render(Wallet.EMPTY, 1, (255,255,255)), (450, 450)
+                                                    self.font2.render(message, 1, (255,255,255)), (450, 450)
                                                     )
                                    )
-                    ''' else, maybe, user wants to buy 100 coins = 2USD '''
-                    if Wallet.COINS in resp[0]:
-                        wallet.set_total_coins(Wallet.DEFAULT_COINS)
-                        wallet.save()
-                else:
-                    ''' user wants to buy 100 coins = 2USD '''
-                    if Wallet.COINS in resp[0]:
-                        wallet.add_coins(Wallet.DEFAULT_COINS)
-                        wallet.save()
-                    else:
-                        ''' user wants to buy some item(s) '''
-                        balance = wallet.get_balance()
-                        if balance == 0:
-                            display.update(self.screen.blit(self.bg, (0,0) ))
-                            display.update(self.screen.blit(
-                                                            self.font2.render(Wallet.EMPTY, 1, (255,255,255)), (450, 450)
-                                                            )
-                                           )
-                        else:
-                            store = db.Store(uid)
-                            product = store.get_product(product_name)
-                            if product:
-                                ''' check if user has enough coins to buy a item from store '''
-                                if wallet.get_payment(int(product.price)):
-                                    wallet.save()
-                                    ''' buy product and save in user store '''
-                                    store.buy(product_name)
-                                else:
-                                    display.update(self.screen.blit(self.bg, (0,0) ))
-                                    display.update(self.screen.blit(
-                                                                    self.font2.render(Wallet.EMPTY, 1, (255,255,255)), (450, 450)
-                                                                    )
-                                                   )
-                                    
     
                 ''' return to menu '''
                 menu = Menu(screen=self.screen, bg=bg,  **self.get_menu(0))
@@ -373,9 +413,9 @@ class MenuActionHandler(object):
             ''' user wants to play this game '''
             if resp[0] == MenuActionHandler.ACTION_PLAY:
                 action_class = self.get_action(MenuActionHandler.ACTION_PLAY)
-                ''' before play load user consumable item from store if exists '''
-                store = db.Store(self.user.id)
-                consumable_item = store.consume_item()  
+                ''' before play load user consumable item from store if exists,
+                    in background while the game is loaded '''
+                consumable_item = db.Store(self.user.id).defer("consume_item")
     
                 ''' load package and game clazz '''
                 package = action_class.keys()[0]
@@ -388,7 +428,7 @@ class MenuActionHandler(object):
                 #game = load_class(module, clazz)
                 game.set_user(self.user)
                 ''' add consumable item from store '''
-                game.set_consumable_item(consumable_item)
+                game.set_consumable_item(self.wait(consumable_item))
                 game.run()
                 show_menu = False    
 
@@ -418,6 +458,7 @@ def run_menu():
     menus = [main_menu, store_menu]
     ''' set menus '''
     menu.add_menu(menus)
+    menu.set_store_menu(1)
     ''' render menu on screen '''
     menu.show()
 
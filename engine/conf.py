@@ -61,6 +61,38 @@ except:
     #WINHEIGHT = 480
     WINHEIGHT = 600
     WINFULL = 0
+try:
+    DIRTY_STATS = int(configParser.get('screen', 'DIRTY_STATS'))
+except:
+    DIRTY_STATS = 0
+try:
+    ROTATION_WARM_UP = int(configParser.get('screen', 'ROTATION_WARM_UP'))
+except:
+    ROTATION_WARM_UP = 0
+
+DB_BACKEND_PICKLE = "pickle"
+DB_BACKEND_SQLITE = "sqlite"
+DB_SQLITE_FILE = "moonlanding.sqlite"
+try:
+    DB_BACKEND = configParser.get('db', 'BACKEND').strip().lower()
+except:
+    DB_BACKEND = DB_BACKEND_PICKLE
+try:
+    DB_SHARDS = int(configParser.get('db', 'SHARDS'))
+except:
+    DB_SHARDS = 4
+try:
+    DB_WRITE_BEHIND = bool(int(configParser.get('db', 'WRITE_BEHIND')))
+except:
+    DB_WRITE_BEHIND = False
+try:
+    DB_SNAPSHOT_HOURS = float(configParser.get('db', 'SNAPSHOT_HOURS'))
+except:
+    DB_SNAPSHOT_HOURS = 24
+try:
+    DB_SNAPSHOTS = int(configParser.get('db', 'SNAPSHOTS'))
+except:
+    DB_SNAPSHOTS = 7
 
 WINWIDTH = max(WINWIDTH, MIN_WINWIDTH)
 WINWIDTH = min(WINWIDTH, MAX_WINWIDTH)
@@ -12,6 +12,8 @@ from engine.Graphics import Circle
 from engine.Widget import VerticalProgressBar, MenuActionHandler, Score
 from engine.Graphics import String
 from engine.Graphics import StaticObject
+from engine.Graphics import bounds
+from engine.Screen import StaticScene
 from engine.Path import AccelerationPath
 from engine import Event
 from engine.Game import Game
@@ -62,7 +64,10 @@ class Lander(MultiRotated):
                 
         MultiRotated.__init__(self, filenames=ship,
                                 steps=60,
-                                colorkey=TRANSPARENT)
+                                colorkey=TRANSPARENT,
+                                lazy=1)
+        if conf.ROTATION_WARM_UP:
+            self.warm_up()
 
         self.path.set_restriction(speed=400)
         self.reset()
@@ -70,10 +75,6 @@ class Lander(MultiRotated):
         self.uprightImage = self.image
         
         self._flip_ticks = 0
-        min_size = min(self.crect.h, self.crect.w)
-        self.crect.h = min_size
-        self.crect.w = min_size
-        self.crect.inflate_ip(-4, -4)
 
     def load_ship(self, consumable_item):
         if hasattr(consumable_item, conf.ITEM_SHIP) and consumable_item.ship is True:
@@ -483,11 +484,10 @@ class MoonLander(Game):
                 ''' 110 - airport size '''
                 x += 110
             else:
-                r = MoonRock((x, y), image=conf.IMG_HARD_GROUND)
-                moon_rocks.append(r.rect)
+                moon_rocks.append(MoonRock((x, y), image=conf.IMG_HARD_GROUND))
                 x += 10
         self.airport = airport
-        self.moon_rocks = moon_rocks
+        self.set_ground(moon_rocks)
         
 
     def create_soft_ground(self):
@@ -499,15 +499,23 @@ class MoonLander(Game):
         y = conf.WINHEIGHT - 60
         moon_rocks = []
         
-        rect_rock = MoonRock((x, y), image=conf.IMG_SOFT_GROUND)
-        moon_rocks.append(rect_rock.rect)
+        moon_rocks.append(MoonRock((x, y), image=conf.IMG_SOFT_GROUND))
 
         x += random.randrange(50, 600)
         if airport is None:
             airport = SpaceAirport((x, y))
 
         self.airport = airport
+        self.set_ground(moon_rocks)
+
+    def set_ground(self, moon_rocks):
+        ''' ground is static, its rects and their bounds are kept for collision checks '''
         self.moon_rocks = moon_rocks
+        self.ground = [rock.rect for rock in moon_rocks]
+        self.ground_bounds = bounds(self.ground)
+
+    def collide_ground(self, sprite):
+        return sprite.collide_mask_any(self.moon_rocks, self.ground, self.ground_bounds) is not None
 
     def create_earth(self):
         """
@@ -621,7 +629,7 @@ class MoonLander(Game):
     def check_shield(self):
         ''' check if lander has shield '''
         if self.consumable_item is None:
-            self.lander.check_if_ship_crash()
+            self.crash()
         else:
             has_shield = False
             if hasattr(self.consumable_item, conf.ITEM_SHIELD) and self.consumable_item.shield is True:
@@ -631,7 +639,7 @@ class MoonLander(Game):
                 self.shield_message.draw()
                 has_shield = True
             if not has_shield:
-                self.lander.check_if_ship_crash()
+                self.crash()
     
     def create_alien_ship(self):
         ''' create alien ship and render on screen '''
@@ -670,6 +678,25 @@ class MoonLander(Game):
         self.start_game_message = StaticObject(sprite=start_game_msg)
         self.start_game_message.draw()
 
+    def save_landing(self, result, points):
+        ''' keep landing in player history and session score on the leaderboard (db worker) '''
+        user = getattr(self, 'user', None)
+        if user is None:
+            return
+        landing = db.Landing(user.id, self.session, result, points, self.score.points)
+        db.post(landing.save)
+        db.post(db.Leaderboard().submit, self.session, self.score.points, user.account)
+
+    def crash(self, penalty=0):
+        ''' crash the lander (once) and keep the crash, penalty points are taken from the score '''
+        if not self.lander.check_if_ship_crash():
+            return False
+        if penalty:
+            self.score.subtract(penalty)
+            self.score.set_score()
+        self.save_landing(db.Landing.CRASHED, -penalty)
+        return True
+
     def check_collision(self):
         """
             Check ship collision with objects (airport, rocks, alien ship, fuel)
@@ -677,7 +704,7 @@ class MoonLander(Game):
         """
         
         ''' check if ship landed '''
-        if self.lander.collide(self.airport):
+        if self.lander.collide_mask(self.airport):
             ship_pos_x, ship_pos_y = self.lander.get_position()
             coord_x = self.lander.cx
             airport_pos_x, airport_pos_y = self.airport.get_position()
@@ -688,40 +715,38 @@ class MoonLander(Game):
                     self.show_landing_message()
                     self.score.add(conf.MIN_POINT_TO_GET)
                     self.score.set_score()
+                    self.save_landing(db.Landing.LANDED, conf.MIN_POINT_TO_GET)
                 self.lander.landing_ship(airport_pos_y)
                 return
             else:
                 ''' we miss the landing! the ship crashed. '''
-                penalty = self.lander.check_if_ship_crash()
-                if penalty:
-                    self.score.subtract(conf.MIN_POINT_TO_GET)
-                    self.score.set_score()
+                self.crash(conf.MIN_POINT_TO_GET)
                 return
             
         ''' check ship collision with ground '''
-        if self.lander.crect.collidelist(self.moon_rocks) != -1:
-            self.lander.check_if_ship_crash()
+        if self.collide_ground(self.lander):
+            self.crash()
             
         ''' check collision with alien ship '''
-        if self.lander.collide(self.alien):
+        if self.lander.collide_mask(self.alien):
             ''' here our ship will crash '''
-            self.lander.check_if_ship_crash()
+            self.crash()
             self.alien.path.approach()
         
         ''' check collision with asteroid '''
         if self.asteroid_drop_object:
-            if self.lander.collide(self.asteroid_drop_object):
-                self.lander.check_if_ship_crash()
+            if self.lander.collide_mask(self.asteroid_drop_object):
+                self.crash()
                 self.remove_asteroid()
             else:
                 ''' check collision with ground. if collide then remove object from screen '''
-                if self.asteroid_drop_object.crect.collidelist(self.moon_rocks) != -1:
+                if self.collide_ground(self.asteroid_drop_object):
                     self.remove_asteroid()
          
         ''' check colission with dropped object '''
         if self.alien_drop_object is not None:
             if not self.lander.crashed and not self.lander.landed:
-                if self.lander.collide(self.alien_drop_object):
+                if self.lander.collide_mask(self.alien_drop_object):
                     ''' if alien drop a bomb then lander will crash if has no shield '''
                     if self.alien_drop_object.is_bomb():
                         ''' check if lander has shield '''
@@ -734,6 +759,8 @@ class MoonLander(Game):
                     
     def start(self):
         ''' before start, draw game elements '''
+        ''' new game session - score starts from zero '''
+        self.session = db.ids.next_id()
         self.draw_static_elements()
         self.create_ship()
         self.set_score()
@@ -775,10 +802,12 @@ class MoonLander(Game):
             draw static elements like earth, stars and ground
             and set background color (black)
         """
-        self.set_background(color=BLACK)
-        self.create_stars()
-        self.create_earth()
-        self.create_ground()
+        ''' all of them are baked into the background, one display update '''
+        with StaticScene(self.window):
+            self.set_background(color=BLACK)
+            self.create_stars()
+            self.create_earth()
+            self.create_ground()
 
     def run(self):
         """
@@ -834,7 +863,7 @@ class MoonLander(Game):
                     empty = 1
 
             dirty = self.sprites.draw()
-            pygame.display.update(dirty)
+            self.update(dirty)
             ''' if game is over do something :) '''
             if over:
                 import time
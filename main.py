@@ -2,33 +2,39 @@ from engine.Widget import MenuActionHandler, TextBox
 from engine.Utility import get_path, read_directories, DEFAULT_IMAGE_DIR, DEFAULT_FONT_DIR, \
      import_module
 from engine.conf import IMG_BACKGROUND, GAME_MENU_ITEMS, DEFAULT_FONT
+from engine import conf
 import db
 
-''' loading products to be render in the menu.store '''
-db_product = db.Product()
-PRODUCTS = db_product.to_list()
-if len(PRODUCTS) == 0:
-    ''' if DB has no products then will save few default products '''
+def bootstrap():
+    ''' one-time setup: if DB has no products then will save few default products '''
+    ''' periodic copy of all tables (see db.Snapshots), reads every table - in db worker '''
+    if conf.DB_SNAPSHOT_HOURS > 0:
+        db.post(db.snapshots.take_if_older, conf.DB_SNAPSHOT_HOURS * 3600, conf.DB_SNAPSHOTS)
+    if db.Product().to_list():
+        return
     product1 = db.Product(name="Blue Ship", description="Super Mega Blue Ship", photo="ship1.img", price="50")
     product1.ship = True
-    product1.save()
-    
+
     product3 = db.Product(name="Shield", description="Megathron blue ship", photo="shield.img", price="20")
     product3.shield = True
-    product3.save()
 
     product4 = db.Product(name="Fuel Pack", description="Slow consume fuel", photo="fuel_pack.img", price="30")
     product4.fuelpack = True
-    product4.save()
 
     product5 = db.Product(name="100 Coins - USD 2", description="Buy 100 coins", photo="coins.img", price="100", currency="USD")
-    product5.save()
-    ''' save all producs in list - used for rendering in store section '''
-    PRODUCTS = db_product.to_list()
-    
-if "BACK" not in PRODUCTS:
-    ''' apply back button. '''
-    PRODUCTS.append("BACK")
+    ''' write all products at once '''
+    db.Product.save_many([product1, product3, product4, product5])
+
+_products = None
+def get_products():
+    ''' products to be render in the menu.store - loaded on first use of the store '''
+    global _products
+    if _products is None:
+        products = db.Product().to_list()
+        ''' apply back button. '''
+        products.append("BACK")
+        _products = products
+    return _products
 
 def render_menu(user):
     ''' Function to display menu on screen ''' 
@@ -50,7 +56,7 @@ def render_menu(user):
                     }
     ''' define store menu '''
     store_menu = { 
-                  "menu": PRODUCTS,
+                  "menu": get_products,
                   "font1": menu.font1,
                   "font2": menu.font1,
                   "pos":  MenuActionHandler.CENTER_POSITION,
@@ -75,6 +81,7 @@ def render_menu(user):
     ''' set menus '''
     menus = [main_menu, store_menu, wallet_menu]
     menu.add_menu(menus)
+    menu.set_store_menu(1)
     ''' set action for each menu item '''
     menu.set_action(MenuActionHandler.ACTION_PLAY, 
                     package="lunar",
@@ -94,6 +101,7 @@ def main():
         ''' create new account with player nickname '''
         user = db.User(account=player_name)
         user.save()
+    bootstrap()
     ''' render and load menu '''
     render_menu(user)
 